@@ -1,9 +1,27 @@
 import argparse
+import copy
+import hashlib
+import html
+import json
+import multiprocessing
 import os
+import queue
 import re
 import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import weakref
+import zipfile
 from abc import ABC, abstractmethod
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from html.parser import HTMLParser
 from pathlib import Path
+from urllib.parse import quote
 
 import anki
 import arrow
@@ -27,28 +45,59 @@ def extract_image_names(text):
     return text_with_prefix_folder, re.findall(image_regex, text)
 
 
-def get_card_ids(deck_manager, did, children=False, include_from_dynamic=False):
-    deck_ids = [did] + ([deck_id for _, deck_id in deck_manager.children(did)] if children else [])
+def is_media_name(name):
+    """Whether the name is a plain file name, media names with path components could be written outside the output"""
+    return name not in ('', '.', '..') and os.path.basename(name) == name and '\\' not in name
 
-    request = "select id from cards where did in {}" + ("or odid in {}" if include_from_dynamic else "")
-    parameters = (anki.utils.ids2str(deck_ids),) + ((deck_manager.utils.ids2str(deck_ids),)
-                                                    if include_from_dynamic else tuple())
 
-    return deck_manager.col.db.list(request.format(*parameters))
+def card_filter(deck_manager, did, children=False, include_from_dynamic=False, shard=None):
+    """
+    SQL condition selecting the cards of the deck from the cards table.
+    :param shard: (index, count) - only select the cards of the index-th of count disjoint slices of the deck.
+     Deck is split by note id, so that all the cards of a note end up in the same slice
+    """
+    deck_ids = anki.utils.ids2str([did] + ([deck_id for _, deck_id in deck_manager.children(did)] if children else []))
 
+    condition = f"(did in {deck_ids}" + (f" or odid in {deck_ids}" if include_from_dynamic else "") + ")"
+    if shard:
+        condition += f" and nid % {shard[1]} = {shard[0]}"
+    return condition
 
-# todo cloze needs work too, I imagine I can translate it to the syntax used in the anki import plugin
-def js():
-    return """function addBrackets() {
-    const elements = document.getElementsByClassName("cloze")
-    for (element of elements) {
-        element.innerHTML = `{${element.innerHTML}}`
-    }
-}
-    """
+
+def get_card_ids(deck_manager, did, children=False, include_from_dynamic=False, shard=None):
+    condition = card_filter(deck_manager, did, children, include_from_dynamic, shard)
+    return deck_manager.col.db.list(f"select id from cards where {condition} order by id")
+
+
+span_tag_regex = re.compile(r'<(/?)span\b([^>]*)>', re.IGNORECASE)
+cloze_class_regex = re.compile(r"""class\s*=\s*["']?(?:[^"'>]*\s)?cloze(?![\w-])""", re.IGNORECASE)
+cloze_deletion_regex = re.compile(r'{{c\d+::(.*?)(?:::.*?)?}}', re.DOTALL)
+
+
+def roam_cloze_html(html):
+    """Wraps the content of rendered cloze deletions in the curly brackets Roam uses for cloze"""
+    parts = []
+    open_spans = []
+    position = 0
+    for tag in span_tag_regex.finditer(html):
+        if not tag.group(1):
+            is_cloze_span = bool(cloze_class_regex.search(tag.group(2)))
+            open_spans.append(is_cloze_span)
+            parts.append(html[position:tag.end()] + ('{' if is_cloze_span else ''))
+        else:
+            is_cloze_span = open_spans.pop() if open_spans else False
+            parts.append(html[position:tag.start()] + ('}' if is_cloze_span else '') + tag.group(0))
+        position = tag.end()
+
+    return ''.join(parts) + html[position:]
 
 
-def get_card_date(card, base_timestamp):
+def roam_cloze_text(text):
+    """Converts Anki cloze deletions in the field text ({{c1::answer::hint}}) to Roam ones ({answer})"""
+    return cloze_deletion_regex.sub(r'{\1}', text)
+
+
+def get_card_date(card, base_timestamp, now=None):
     """
      -- Due is used differently for different card types:
      --   new: note id or random int
@@ -60,7 +109,7 @@ def get_card_date(card, base_timestamp):
 
      Need to take into account dates in the past, (probably should map to today)
     """
-    now = arrow.now()
+    now = now or arrow.now()
     if card.type == 0:
         return None
     elif card.type == 1:
@@ -70,6 +119,71 @@ def get_card_date(card, base_timestamp):
         return max(due_date, now)
 
 
+due_buckets = ['new', 'due today', 'due within a week', 'due within a month', 'due later']
+
+
+def due_bucket(date, now):
+    if not date:
+        return 'new'
+    days = (date.floor('day') - now.floor('day')).days
+    return 'due today' if days <= 0 else 'due within a week' if days <= 7 \
+        else 'due within a month' if days <= 30 else 'due later'
+
+
+def tag_ancestors(tag):
+    """The tag with all its parents, e.g. a, a::b and a::b::c for a::b::c"""
+    parts = tag.split('::')
+    return ['::'.join(parts[:end]) for end in range(1, len(parts) + 1)]
+
+
+def tag_summary(entry):
+    due = ', '.join(f"{entry['due'][it]} {it}" for it in due_buckets if entry['due'].get(it))
+    return f"{entry['cards']} cards ({due})"
+
+
+css_tokens = re.compile(r'''/\*.*?\*/|("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')''', re.DOTALL)
+
+
+def css_pieces(css):
+    """
+    Splits the stylesheet into the text between the quoted strings, at the even indexes, and the strings, at the odd
+    ones, so that only the text is rewritten. Comments are dropped, the quotes they contain don't start strings.
+    """
+    pieces, start = [''], 0
+    for match in css_tokens.finditer(css):
+        pieces[-1] += css[start:match.start()]
+        if match.group(1):
+            pieces += [match.group(1), '']
+        start = match.end()
+    pieces[-1] += css[start:]
+    return pieces
+
+
+def minify_css(css):
+    pieces = css_pieces(css)
+    for index in range(0, len(pieces), 2):
+        text = re.sub(r'\s+', ' ', pieces[index])
+        text = re.sub(r'\s*([{};,>])\s*', r'\1', text)
+        text = re.sub(r':\s+', ':', text)
+        pieces[index] = text.replace(';}', '}')
+    return ''.join(pieces).strip()
+
+
+def css_rules(css):
+    pieces = css_pieces(css)
+    # only split simple stylesheets, at-rules have nested blocks
+    if any('@' in text for text in pieces[::2]):
+        return [css]
+    rules = ['']
+    for index, piece in enumerate(pieces):
+        first, *rest = [piece] if index % 2 else piece.split('}')
+        rules[-1] += first
+        for rule in rest:
+            rules[-1] += '}'
+            rules.append(rule)
+    return [rule for rule in rules if rule]
+
+
 def roam_date(date):
     return f"[[{date.format('MMMM Do, YYYY')}]]" if date else ""
 
@@ -79,30 +193,254 @@ def format_tags(tags):
 
 
 def insert_metadata(answer: str, metadata):
+    match = None
     for match in re.finditer("</\\w+?>", answer):
         pass
 
     if match:
         return answer[:match.start()] + metadata + answer[match.start():]
-    return answer + match
+    return answer + metadata
 
 
 class Exporter(ABC):
-    def __init__(self, deck_name: str, profile_directory: str, file_suffix: str = ".html", collection=None):
+    def __init__(self, deck_name: str, profile_directory: str, file_suffix: str = ".html", collection=None,
+                 children=False, include_from_dynamic=False, render_cache=None, image_optimizer=None, shard=None,
+                 pipelined=False, package=None, checkpoint_every=None, resume=False, now=None, fields=None,
+                 tag_index=False):
+        """
+        :param profile_directory: the Anki profile directory, an .apkg/.colpkg file to export from directly,
+         or a .snapshot file written by extract_snapshot
+        :param package: an opened AnkiPackage to export from, e.g. to share it between the exports of several formats
+        :param checkpoint_every: save the progress to checkpoint files next to the output after every this many cards
+         and copied media files, so that an interrupted export can be continued with resume
+        :param resume: continue from the checkpoint of an interrupted export if there is one, the checkpoint is only
+         used if the collection and the export options haven't changed since it was saved
+        :param now: the date to use for today instead of the current one, e.g. for reproducible exports
+        :param fields: {model name: [field names]} - export only these fields of the notes of the listed models,
+         the other fields are blanked before rendering, so they are never converted or scanned for media
+        :param tag_index: also write an index of the tags of the exported cards (including the parents of the
+         hierarchical tags) with the number of cards and when they are due, built as the cards are exported
+        :param shard: (index, count) - export only the index-th of count disjoint slices of the deck,
+         the outputs of all the slices are combined with merge_shards
+        :param pipelined: run the stages of the export concurrently (see export_pipelined)
+        """
         self.deck_name = deck_name
-        self.profile_directory = profile_directory
+        # Anki moves the working directory to the media folder while a collection is open, so the profile and output
+        # paths are made absolute up front (a caller passing an opened collection passes absolute paths)
+        self.profile_directory = profile_directory and os.path.abspath(profile_directory)
         self.file_suffix = file_suffix
-        self.collection = collection or self.load_collection()
-        self.css_fragments = ["div {display: inline;}"]
+        # A collection passed in belongs to the caller (e.g. a CollectionPool), so we leave it open
+        self.owns_collection = collection is None
+        self._collection = collection
+        self.children = children
+        self.include_from_dynamic = include_from_dynamic
+        self.render_cache = render_cache
+        self.image_optimizer = image_optimizer
+        self.shard = shard
+        self.pipelined = pipelined
+        self.package = package
+        self.checkpoint_every = checkpoint_every
+        self.resume = resume
+        self.now = now
+        self.fields = fields or {}
+        self.tag_index = tag_index
+        self.tags = {}  # tag -> {'cards': count, 'due': {due bucket: count}}
+        self.checkpoint_path = None
+        self.progress_path = None
+        self.fingerprint = None
+        self.position = 0
+        self.copied_media = set()
+        self.saved_cards, self.saved_images, self.unsaved_media = 0, 0, []
+        self.crt = None
+        self.models = {}
+        self.card_ids = []
         self.card_fragments = []
         self.images = []
+        self.metrics = {
+            'deck': deck_name,
+            'format': self.format_name(),
+            'cards': 0,
+            'suspended_cards': 0,
+            'stage_seconds': {},
+            'bytes_written': 0,
+            'media_copied': 0,
+            'media_skipped': 0,
+            'media_missing': 0,
+        }
+
+    @property
+    def collection(self):
+        if self._collection is None:
+            self._collection = self.load_collection()
+        return self._collection
+
+    def format_name(self):
+        return next((name for name, exporter in exporters.items() if exporter is type(self)), type(self).__name__)
+
+    @contextmanager
+    def timed(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stages = self.metrics['stage_seconds']
+            stages[stage] = stages.get(stage, 0) + time.perf_counter() - start
+
+    def write_file(self, path, text):
+        path = Path(path)
+        path.write_text(text)
+        self.metrics['bytes_written'] += path.stat().st_size
 
     def export(self, output_dir):
+        output_dir = os.path.abspath(output_dir)
+        if self.pipelined:
+            return self.export_pipelined(output_dir)
+
+        if self.checkpoint_every:
+            output_path = self.shard_path(output_dir) if self.shard else self.output_path(output_dir)
+            self.checkpoint_path = f"{output_path}.checkpoint.json"
+            self.progress_path = f"{output_path}.checkpoint.jsonl"
+            os.makedirs(output_dir, exist_ok=True)
+
         self.build_export_context()
+        if self.checkpoint_path:
+            self.save_checkpoint()
+
+        with self.timed('media'):
+            renamed_media = self.copy_images(output_dir)
+        if renamed_media:
+            self.card_fragments = [rename_media_references(it, renamed_media) for it in self.card_fragments]
+            self.images = [renamed_media.get(it, it) for it in self.images]
+
+        with self.timed('write'):
+            if self.shard:
+                self.write_shard(output_dir)
+            else:
+                self.write_output(output_dir)
+
+        if self.checkpoint_path:
+            os.remove(self.checkpoint_path)
+            os.remove(self.progress_path)
+
+    def save_checkpoint(self):
+        """
+        Appends the cards, images and media done since the last save to the progress file, then saves the checkpoint
+        with the rest of the state and the size of the progress file. The checkpoint is replaced atomically, so that
+        an interruption while saving doesn't lose the previous one, and the progress appended after it is ignored.
+        """
+        batch = {
+            'card_ids': self.card_ids[self.saved_cards:],
+            'card_fragments': self.card_fragments[self.saved_cards:],
+            'images': self.images[self.saved_images:],
+            'copied_media': self.unsaved_media,
+        }
+        if any(batch.values()):
+            with open(self.progress_path, 'a') as progress:
+                progress.write(json.dumps(batch) + '\n')
+        self.saved_cards, self.saved_images, self.unsaved_media = len(self.card_ids), len(self.images), []
 
-        Path(output_dir).joinpath(self.deck_name).with_suffix(self.file_suffix) \
-            .write_text(self.get_aggregate())
-        self.copy_images(output_dir)
+        temporary = f"{self.checkpoint_path}.{os.getpid()}.tmp"
+        Path(temporary).write_text(json.dumps({
+            'fingerprint': self.fingerprint,
+            'now': self.now.isoformat(),
+            'position': self.position,
+            'progress_size': os.path.getsize(self.progress_path),
+            'suspended_cards': self.metrics['suspended_cards'],
+            'models': self.models,
+            'tags': self.tags,
+        }))
+        os.replace(temporary, self.checkpoint_path)
+
+    def load_checkpoint(self):
+        if not self.resume or not os.path.exists(self.checkpoint_path):
+            if self.resume:
+                print(f"No checkpoint to resume {self.deck_name} export from")
+            # drops the checkpoint and the progress of an earlier export that isn't resumed, the checkpoint first,
+            # so that it's never left pointing to progress that is gone
+            if os.path.exists(self.checkpoint_path):
+                os.remove(self.checkpoint_path)
+            open(self.progress_path, 'w').close()
+            return
+
+        checkpoint = json.loads(Path(self.checkpoint_path).read_text())
+        if checkpoint['fingerprint'] != self.fingerprint:
+            raise ValueError(f"The collection or the export options have changed since the checkpoint "
+                             f"{self.checkpoint_path} was saved, delete it to export from the beginning")
+
+        if not os.path.exists(self.progress_path) or \
+                os.path.getsize(self.progress_path) < checkpoint['progress_size']:
+            raise ValueError(f"The progress saved with the checkpoint {self.checkpoint_path} is incomplete, "
+                             f"delete the checkpoint to export from the beginning")
+        with open(self.progress_path, 'rb') as progress:
+            saved = progress.read(checkpoint['progress_size']).splitlines()
+        os.truncate(self.progress_path, checkpoint['progress_size'])
+        for line in saved:
+            batch = json.loads(line)
+            self.card_ids += batch['card_ids']
+            self.card_fragments += batch['card_fragments']
+            self.images += batch['images']
+            self.copied_media.update(batch['copied_media'])
+        self.saved_cards, self.saved_images = len(self.card_ids), len(self.images)
+
+        self.position = checkpoint['position']
+        self.metrics['suspended_cards'] = checkpoint['suspended_cards']
+        # JSON object keys are strings, model ids are ints
+        self.models = {int(mid): model for mid, model in checkpoint['models'].items()}
+        self.tags = checkpoint['tags']
+        # the dates of the resumed cards are relative to the same day as those of the checkpointed ones
+        self.now = self.now or arrow.get(checkpoint['now'])
+        print(f"Resuming {self.deck_name} export from the checkpoint with {len(self.card_ids)} cards")
+
+    def output_path(self, output_dir):
+        return Path(output_dir).joinpath(self.deck_name).with_suffix(self.file_suffix)
+
+    def write_output(self, output_dir):
+        self.write_file(self.output_path(output_dir), self.get_aggregate())
+        self.write_assets(output_dir)
+
+    def write_assets(self, output_dir):
+        """Writes the files that accompany the main output file"""
+        if self.tag_index:
+            self.write_file(Path(output_dir).joinpath(f"{self.deck_name}.tags{self.file_suffix}"), self.get_tag_index())
+
+    def output_options(self):
+        """Constructor options that affect write_output, needed to merge the shards the same way"""
+        return dict(tag_index=self.tag_index)
+
+    def checkpoint_options(self):
+        """Constructor options that affect the checkpointed progress, a checkpoint is only resumed with the same ones"""
+        optimizer = self.image_optimizer
+        return dict(self.output_options(), fields=self.fields, now=self.now and self.now.isoformat(),
+                    images=optimizer and [optimizer.max_dimension, optimizer.quality, optimizer.image_format])
+
+    def index_tags(self, card, note):
+        now = self.now or arrow.now()
+        bucket = due_bucket(get_card_date(card, self.crt, now), now)
+        for tag in dict.fromkeys(it for tag in note.tags for it in tag_ancestors(tag)):
+            entry = self.tags.setdefault(tag, {'cards': 0, 'due': {}})
+            entry['cards'] += 1
+            entry['due'][bucket] = entry['due'].get(bucket, 0) + 1
+
+    def tag_index_entries(self):
+        """(depth, tag, entry) of the indexed tags, the sub-tags follow their parents"""
+        for tag in sorted(self.tags, key=lambda it: it.split('::')):
+            yield tag.count('::'), tag, self.tags[tag]
+
+    def shard_path(self, output_dir):
+        index, count = self.shard
+        return Path(output_dir).joinpath(f"{self.deck_name}{self.file_suffix}.shard-{index}-of-{count}.json")
+
+    def write_shard(self, output_dir):
+        self.write_file(self.shard_path(output_dir), json.dumps({
+            'deck_name': self.deck_name,
+            'format': self.format_name(),
+            'options': self.output_options(),
+            'shard': self.shard,
+            'css': {mid: model['css'] for mid, model in self.models.items()},
+            'cards': list(zip(self.card_ids, self.card_fragments)),
+            'media': list(dict.fromkeys(self.images)),
+            'tags': self.tags,
+        }))
 
     def export_text(self):
         self.build_export_context()
@@ -110,22 +448,164 @@ class Exporter(ABC):
 
     def build_export_context(self):
         print(f"Exporting {self.deck_name} deck")
-        for card in get_cards(self.collection, self.deck_name):
-            note = self.collection.getNote(card.nid)
-            self.css_fragments.append(self.collection.models.get(note.mid)['css'])
+        try:
+            for card, note in self.load_cards():
+                with self.timed('render'):
+                    answer_text, images = self.render_card(card, note)
+                with self.timed('format'):
+                    self.card_fragments.append(self.get_card_fragment(answer_text, card, note))
+                    if self.tag_index:
+                        self.index_tags(card, note)
+                self.images += images
+                self.card_ids.append(card.id)
+                if self.checkpoint_path and len(self.card_ids) % self.checkpoint_every == 0:
+                    self.save_checkpoint()
+        finally:
+            if self.owns_collection:
+                self.collection.close()
+
+        self.metrics['cards'] = len(self.card_fragments)
+        print(f"Exporting {len(self.card_fragments)} cards")
+
+    def load_cards(self):
+        """Yields the exported cards with their notes, skipping suspended cards"""
+        with self.timed('load'):
+            if isinstance(self.collection, Snapshot):
+                card_ids = self.collection.card_ids(self.deck_name, self.shard)
+            else:
+                check_fields_models(self.collection, self.fields)
+                card_ids = get_card_ids(self.collection.decks, deck_id(self.collection, self.deck_name),
+                                        self.children, self.include_from_dynamic, self.shard)
+            self.crt = self.collection.crt
+            if self.checkpoint_path:
+                fingerprint = json.dumps([self.collection.mod, card_ids, self.format_name(), self.checkpoint_options()],
+                                         sort_keys=True)
+                self.fingerprint = hashlib.sha1(fingerprint.encode()).hexdigest()
+                self.load_checkpoint()
+                self.now = self.now or arrow.now()
+        for position in range(self.position, len(card_ids)):
+            with self.timed('load'):
+                card = self.collection.getCard(card_ids[position])
+                # the number of cards done once the consumer has processed this one
+                self.position = position + 1
+                if not is_not_suspended(card):
+                    self.metrics['suspended_cards'] += 1
+                    continue
+                note = self.collection.getNote(card.nid)
+            yield card, note
+
+    def export_pipelined(self, output_dir, queue_size=256):
+        """
+        Same as export, but with the stages running concurrently, connected with bounded queues: loading and
+        rendering the cards (the only stage using the collection), formatting them, writing the output, and copying
+        the media, which starts as soon as the first image reference is found.
+        """
+        if self.shard or self.checkpoint_every or type(self).get_aggregate is not Exporter.get_aggregate:
+            raise ValueError(f"Pipelined export is not supported for sharded, checkpointed or {self.format_name()} "
+                             f"exports")
+
+        os.makedirs(output_dir, exist_ok=True)
+
+        print(f"Exporting {self.deck_name} deck")
+        pipeline = Pipeline()
+        rendered, formatted, media = (queue.Queue(queue_size) for _ in range(3))
+        rename = self.image_optimizer.output_name if self.image_optimizer else lambda it: it
+        header, separator, footer = self.aggregate_parts()
+        # before the stages start, as the media source of a package is shared with the collection loading
+        media_source = self.media_source()
+        output_path = self.output_path(output_dir)
+        body_path = output_path.with_name(output_path.name + '.part')
 
-            rendering = TemplateRenderContext.from_existing_card(card, False).render()
+        def render():
+            seen_media = set()
+            try:
+                for card, note in self.load_cards():
+                    with self.timed('render'):
+                        answer_text, images = self.render_card(card, note)
+                    for image in images:
+                        if image not in seen_media:
+                            seen_media.add(image)
+                            pipeline.put(media, image)
+                    pipeline.put(rendered, (card, note, answer_text, images))
+            finally:
+                if self.owns_collection:
+                    self.collection.close()
 
-            answer_text, images = extract_image_names(rendering.answer_text)
-            self.images += images
-            self.card_fragments.append(self.get_card_fragment(answer_text, card, note))
+        def format_cards():
+            for card, note, answer_text, images in pipeline.items(rendered):
+                with self.timed('format'):
+                    fragment = self.get_card_fragment(answer_text, card, note)
+                    if self.tag_index:
+                        self.index_tags(card, note)
+                pipeline.put(formatted, (card.id, fragment, images))
 
-        self.collection.close()
+        def write():
+            with open(body_path, 'w') as body:
+                for card_id, fragment, images in pipeline.items(formatted):
+                    with self.timed('write'):
+                        renamed_media = {it: rename(it) for it in images if rename(it) != it}
+                        fragment = rename_media_references(fragment, renamed_media) if renamed_media else fragment
+                        body.write(separator + fragment if self.card_fragments else fragment)
+                        self.card_ids.append(card_id)
+                        self.card_fragments.append(fragment)
+                        self.images += [rename(it) for it in images]
 
+        def copy_media():
+            with self.media_copier(output_dir, media_source) as copy:
+                for name in pipeline.items(media):
+                    with self.timed('media'):
+                        copy(name)
+
+        pipeline.run(render, rendered, media)
+        pipeline.run(format_cards, formatted)
+        pipeline.run(write)
+        pipeline.run(copy_media)
+        try:
+            pipeline.join()
+            with self.timed('write'):
+                # the header has to be built after all the cards are loaded, as it includes the styles of their models
+                header, _, footer = self.aggregate_parts()
+                with open(output_path, 'w') as output, open(body_path) as body:
+                    output.write(header)
+                    shutil.copyfileobj(body, output)
+                    output.write(footer)
+                self.metrics['bytes_written'] += output_path.stat().st_size
+                self.write_assets(output_dir)
+        finally:
+            if body_path.exists():
+                body_path.unlink()
+
+        self.metrics['cards'] = len(self.card_fragments)
         print(f"Exporting {len(self.card_fragments)} cards")
 
+    def get_model(self, mid):
+        if mid not in self.models:
+            self.models[mid] = check_fields(self.collection.models.get(mid), self.fields)
+        return self.models[mid]
+
+    def exported_fields(self, note):
+        """Values of the exported fields of the note, in the order of the model"""
+        names = self.fields.get(self.get_model(note.mid)['name'])
+        return note.fields if names is None else [value for name, value in note.items() if name in names]
+
+    def render_card(self, card, note):
+        model = self.get_model(note.mid)
+        if isinstance(card, SnapshotCard):
+            return card.answer, card.media
+
+        names = self.fields.get(model['name'])
+        variant = ','.join(names) if names is not None else ''
+        cached = self.render_cache and self.render_cache.get(card, note, model, variant)
+        if cached:
+            return cached
+
+        answer_text, images = render_answer(self.collection, card, note, model, names)
+        if self.render_cache:
+            self.render_cache.put(card, note, model, answer_text, images, variant)
+        return answer_text, images
+
     def get_card_metadata(self, card, note):
-        date = roam_date(get_card_date(card, self.collection.crt))
+        date = roam_date(get_card_date(card, self.crt, self.now))
         # todo filter empty strings
         metadata = seq(f"[[[[interval]]:{card.ivl}]]" if card.ivl else "",
                        f"[[[[factor]]:{card.factor / 1000}]]" if card.factor else "",
@@ -133,103 +613,1302 @@ class Exporter(ABC):
                        format_tags(note.tags)).filter(lambda it: it).to_list()
         return metadata
 
+    def get_css(self):
+        """Minified CSS of all the models used by the exported cards, in a stable order"""
+        fragments = ["div {display: inline;}"] + [self.models[mid]['css'] for mid in sorted(self.models)]
+        return '\n'.join(dict.fromkeys(rule for it in fragments for rule in css_rules(minify_css(it))))
+
     def load_collection(self):
-        collection_path = os.path.join(self.profile_directory, "collection.anki2")
-        return Collection(collection_path, log=True)
+        if is_snapshot(self.profile_directory):
+            snapshot = Snapshot(self.profile_directory)
+            if self.fields and self.fields != snapshot.fields:
+                snapshot.close()
+                raise ValueError(f"{self.profile_directory} was extracted with other fields, extract it again")
+            return snapshot
+        if self.package or is_package(self.profile_directory):
+            self.package = self.package or AnkiPackage(self.profile_directory)
+            return self.package.open_collection()
+        return Collection(collection_path(self.profile_directory), log=True)
+
+    def media_source(self):
+        # the media of a snapshot is copied from the profile or package it was extracted from
+        source = snapshot_source(self.profile_directory) if is_snapshot(self.profile_directory) \
+            else self.profile_directory
+        if self.package or is_package(source):
+            self.package = self.package or AnkiPackage(source)
+            return self.package
+        media_folder = os.path.join(source, "collection.media/")
+        return MediaFolder(media_folder) if os.path.exists(media_folder) else None
 
     def copy_images(self, output_dir):
-        src_media_folder = os.path.join(self.profile_directory, "collection.media/")
+        """Copies the referenced media to the output directory, returns {original name: new name} of renamed files"""
+        with self.media_copier(output_dir, self.media_source()) as copy:
+            for media in dict.fromkeys(self.images):
+                if media in self.copied_media:
+                    continue
+                copy(media)
+                # optimized images are only done when the copier exits, they are quick to redo from the image cache
+                if self.checkpoint_path and not self.image_optimizer:
+                    self.copied_media.add(media)
+                    self.unsaved_media.append(media)
+                    if len(self.copied_media) % self.checkpoint_every == 0:
+                        self.save_checkpoint()
+        return {media: self.image_optimizer.output_name(media) for media in dict.fromkeys(self.images)
+                if self.image_optimizer and self.image_optimizer.output_name(media) != media}
+
+    @contextmanager
+    def media_copier(self, output_dir, media_source):
+        """Yields a function copying one media file to the output, files are optimized in the background"""
         dest_media_folder = os.path.join(output_dir, target_media_folder)
-        if not os.path.exists(src_media_folder):
+        if not media_source:
             print("Skipping media export as source media folder does not exist")
+            yield lambda media: None
             return
 
         # Create target directory if not exists
         if not os.path.exists(dest_media_folder):
             os.makedirs(dest_media_folder)
 
-        for media in self.images:
-            src = os.path.join(src_media_folder, media)
-            dest = os.path.join(dest_media_folder, media)
-            shutil.copyfile(src, dest)
+        def copy(media, pool=None):
+            if not is_media_name(media) or not media_source.exists(media):
+                print(f"Skipping missing media file {media}")
+                self.metrics['media_missing'] += 1
+            elif pool:
+                futures.append(self.image_optimizer.submit(pool, media_source.path(media), dest_media_folder))
+                self.metrics['media_copied'] += 1
+            elif media_source.copy(media, os.path.join(dest_media_folder, media)):
+                self.metrics['media_copied'] += 1
+            else:
+                self.metrics['media_skipped'] += 1
+
+        if not self.image_optimizer:
+            yield copy
+            return
+
+        futures = []
+        with self.image_optimizer.pool() as pool:
+            yield lambda media: copy(media, pool)
+            for future in futures:
+                future.result()
 
     @abstractmethod
     def get_card_fragment(self, answer, card, tags) -> str:
         pass
 
-    @abstractmethod
     def get_aggregate(self) -> str:
+        header, separator, footer = self.aggregate_parts()
+        return header + separator.join(self.card_fragments) + footer
+
+    @abstractmethod
+    def aggregate_parts(self):
+        """The text before the cards, between every two cards and after the cards in the output"""
+        pass
+
+    @abstractmethod
+    def get_tag_index(self) -> str:
         pass
 
 
 class HtmlExporter(Exporter):
+    def __init__(self, deck_name: str, profile_directory: str, shared_css=False, **kwargs):
+        """
+        :param shared_css: write the styles into a separate content-addressed .css file, so that exports of
+         multiple decks can share it, instead of inlining them into the page
+        """
+        super().__init__(deck_name, profile_directory, **kwargs)
+        self.shared_css = shared_css
+
+    def write_assets(self, output_dir):
+        super().write_assets(output_dir)
+        if self.shared_css:
+            self.write_file(Path(output_dir).joinpath(self.stylesheet_name()), self.get_css())
+
+    def output_options(self):
+        return dict(super().output_options(), shared_css=self.shared_css)
+
+    def stylesheet_name(self):
+        return f"anki2roam-{hashlib.sha1(self.get_css().encode()).hexdigest()[:12]}.css"
 
     # todo the extra info ending up in a separate block is a big problem -_-
     # also image export does not really work - it embeds the link and not copies the image
     def get_card_fragment(self, answer, card, note):
         metadata = self.get_card_metadata(card, note)
         metadata = f"<span>{' '.join(metadata)}</span>"
-        return f"""<div class="card"> {insert_metadata(answer, metadata)} </div>"""
+        return f"""<div class="card"> {roam_cloze_html(insert_metadata(answer, metadata))} </div>"""
+
+    def get_tag_index(self):
+        items = '\n'.join(f'<li style="margin-left: {depth * 2}em">{html.escape(tag)} - {tag_summary(entry)}</li>'
+                          for depth, tag, entry in self.tag_index_entries())
+        return f"""<!doctype html>
+    <html>
+    <head>
+      <meta charset="utf-8">
+      <title>{self.deck_name} tags</title>
+    </head>
+    <body>
+      <ul style="list-style: none">
+{items}
+      </ul>
+    </body>
+    </html>"""
+
+    def style_tag(self):
+        """Link to the shared stylesheet or the inline styles, for the head of the page"""
+        return f'<link rel="stylesheet" href="{self.stylesheet_name()}">' if self.shared_css \
+            else f"<style>\n      {self.get_css()}\n      </style>"
+
+    def aggregate_parts(self):
+        return f"""<!doctype html>
+    <html>
+    <head>
+      <meta charset="utf-8">
+      <title>{self.deck_name}</title>
+      {self.style_tag()}
+    </head>
+    <body>
+      """, '\n', """ </body>
+    </html>"""
+
+
+chunked_viewer_js = """
+const cardsElement = document.getElementById("cards")
+const moreElement = document.getElementById("more")
+const allCards = Array.from({length: cardCount}, (_, card) => card)
+const chunks = []
+const loadedChunks = []
+let shownCards = allCards, renderedCount = 0, loading = false, generation = 0
+
+function anki2roamChunk(index, cards) {
+    loadedChunks[index] = cards
+}
+
+function loadChunk(index) {
+    if (!chunks[index]) {
+        chunks[index] = new Promise(resolve => {
+            const script = document.createElement("script")
+            script.src = `${dataFolder}/chunk-${index}.js`
+            script.onload = resolve
+            document.head.appendChild(script)
+        })
+    }
+    return chunks[index]
+}
+
+function cardHtml(card) {
+    return loadedChunks[Math.floor(card / chunkSize)][card % chunkSize]
+}
+
+async function renderMore() {
+    if (loading || renderedCount >= shownCards.length) return
+    loading = true
+    const current = generation
+    const page = shownCards.slice(renderedCount, renderedCount + chunkSize)
+    await Promise.all([...new Set(page.map(card => Math.floor(card / chunkSize)))].map(loadChunk))
+    if (current !== generation) return
+
+    cardsElement.insertAdjacentHTML("beforeend", page.map(cardHtml).join("\\n"))
+    renderedCount += page.length
+    loading = false
+    if (moreElement.getBoundingClientRect().top < window.innerHeight * 2) renderMore()
+}
+
+function show(cards) {
+    generation++
+    shownCards = cards
+    renderedCount = 0
+    loading = false
+    cardsElement.innerHTML = ""
+    renderMore()
+}
+
+function tokenize(text) {
+    return text.toLowerCase().match(/[\\p{L}\\p{N}_]+/gu) || []
+}
+
+function search(query) {
+    let found = null
+    for (const token of tokenize(query)) {
+        const words = Object.keys(anki2roamSearchIndex).filter(word => word.startsWith(token))
+        const postings = new Set(words.flatMap(word => anki2roamSearchIndex[word]))
+        found = found ? found.filter(card => postings.has(card)) : [...postings].sort((a, b) => a - b)
+    }
+    show(found || allCards)
+}
+
+new IntersectionObserver(entries => entries[0].isIntersecting && renderMore(), {rootMargin: "100%"})
+    .observe(moreElement)
+const searchElement = document.getElementById("search")
+if (searchElement) searchElement.addEventListener("input", () => search(searchElement.value))
+renderMore()
+"""
+
+
+def search_tokens(fragment):
+    return re.findall(r'\w+', html.unescape(re.sub(r'<[^>]+>', ' ', fragment)).lower())
+
+
+class ChunkedHtmlExporter(HtmlExporter):
+    """
+    HTML export that stays usable in a browser for huge decks: the cards are stored in chunked data files
+    and a small viewer page renders them as the user scrolls, with lazily loaded images.
+    Optionally builds a search index at export time, which the viewer uses to show only the matching cards.
+    """
+
+    def __init__(self, deck_name: str, profile_directory: str, chunk_size=500, search_index=False, **kwargs):
+        super().__init__(deck_name, profile_directory, **kwargs)
+        self.chunk_size = chunk_size
+        self.search_index = search_index
+
+    def data_folder(self):
+        return f"{self.deck_name}_cards"
+
+    def get_card_fragment(self, answer, card, note):
+        return super().get_card_fragment(answer, card, note).replace('<img ', '<img loading="lazy" ')
+
+    def output_options(self):
+        return dict(super().output_options(), chunk_size=self.chunk_size, search_index=self.search_index)
+
+    def write_assets(self, output_dir):
+        super().write_assets(output_dir)
+
+        data_folder = Path(output_dir).joinpath(self.data_folder())
+        data_folder.mkdir(exist_ok=True)
+        for start in range(0, len(self.card_fragments), self.chunk_size):
+            chunk = self.card_fragments[start:start + self.chunk_size]
+            self.write_file(data_folder.joinpath(f"chunk-{start // self.chunk_size}.js"),
+                            f"anki2roamChunk({start // self.chunk_size}, {json.dumps(chunk)})")
+
+        if self.search_index:
+            index = {}
+            for card, fragment in enumerate(self.card_fragments):
+                for token in dict.fromkeys(search_tokens(fragment)):
+                    index.setdefault(token, []).append(card)
+            self.write_file(data_folder.joinpath("search.js"), f"const anki2roamSearchIndex = {json.dumps(index)}")
 
     def get_aggregate(self):
-        css_str = '\n'.join(set(self.css_fragments))
-        cards_str = '\n'.join(self.card_fragments)
+        data_folder = quote(self.data_folder())
+        search = f"""<input id="search" type="search" placeholder="Search">
+      <script src="{data_folder}/search.js"></script>""" if self.search_index else ""
 
         return f"""<!doctype html>
     <html>
     <head>
       <meta charset="utf-8">
       <title>{self.deck_name}</title>
-      <style>
-      {css_str}
-      </style>
-      <script>{js()}</script> 
+      {self.style_tag()}
+      <style>.card{{content-visibility:auto;contain-intrinsic-size:auto 200px}}</style>
     </head>
-    <body onload="addBrackets();">
-      {cards_str} </body>
+    <body>
+      {search}
+      <div id="cards"></div>
+      <div id="more"></div>
+      <script>
+      const dataFolder = {json.dumps(data_folder)}, chunkSize = {self.chunk_size}, cardCount = {len(self.card_fragments)}
+      {chunked_viewer_js.strip()}
+      </script>
+    </body>
     </html>"""
 
 
+class UnsupportedHtml(Exception):
+    pass
+
+
+class FieldMarkdownConverter(HTMLParser):
+    """
+    Streaming HTML to Markdown converter for the limited HTML Anki fields contain, producing the same output as
+    markdownify without building a BeautifulSoup tree. Raises UnsupportedHtml for constructs it doesn't handle
+    the same way (comments, headings, malformed nesting, unusual entities, etc.)
+    """
+
+    void_tags = {'area', 'base', 'basefont', 'bgsound', 'br', 'col', 'command', 'embed', 'frame', 'hr', 'image',
+                 'img', 'input', 'isindex', 'keygen', 'link', 'menuitem', 'meta', 'nextid', 'param', 'source',
+                 'spacer', 'track', 'wbr'}
+    unsupported_tags = re.compile(r'h\d+|hn|blockquote|list|script|style')
+    entities = {'amp': '&', 'lt': '<', 'gt': '>', 'quot': '"', 'nbsp': '\xa0'}
+    whitespace_regex = re.compile(r'[\r\n\s\t ]+')
+    bullets = '*+-'
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        # [tag, attributes, converted children, number of children]
+        self.stack = [['div', {}, [], 0]]
+        self.text = []
+
+    def convert(self, field_html):
+        # same as markdownify, which wraps the field into a div, so that trailing entities get terminated
+        self.feed(field_html + '</anki2roam-field>')
+        self.close()
+        self.flush_text()
+        while len(self.stack) > 1:
+            self.close_tag()
+        return ''.join(self.stack[0][2])
+
+    def flush_text(self):
+        if self.text:
+            text = self.whitespace_regex.sub(' ', ''.join(self.text)).replace('_', r'\_')
+            self.stack[-1][2].append(text)
+            self.stack[-1][3] += 1
+            self.text = []
+
+    def handle_starttag(self, tag, attrs):
+        if self.unsupported_tags.fullmatch(tag):
+            raise UnsupportedHtml(tag)
+        self.flush_text()
+        self.stack.append([tag, {name: value or '' for name, value in attrs}, [], 0])
+        if tag in self.void_tags:
+            self.close_tag()
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in self.void_tags:
+            self.close_tag()
+
+    def handle_endtag(self, tag):
+        self.flush_text()
+        if tag == 'anki2roam-field':
+            return
+        if len(self.stack) == 1 or self.stack[-1][0] != tag:
+            raise UnsupportedHtml(f"</{tag}>")
+        self.close_tag()
+
+    def handle_data(self, data):
+        self.text.append(data)
+
+    def handle_entityref(self, name):
+        if name not in self.entities:
+            raise UnsupportedHtml(f"&{name}")
+        self.text.append(self.entities[name])
+
+    def handle_charref(self, name):
+        try:
+            code = int(name[1:], 16) if name[0] in 'xX' else int(name)
+            if 0x80 <= code <= 0x9f:
+                raise ValueError
+            # like html.unescape, NUL and the surrogates become the replacement character
+            self.text.append('\ufffd' if code == 0 or 0xd800 <= code <= 0xdfff else chr(code))
+        except (ValueError, OverflowError):
+            raise UnsupportedHtml(f"&#{name}")
+
+    def handle_comment(self, data):
+        raise UnsupportedHtml("comment")
+
+    def handle_decl(self, decl):
+        raise UnsupportedHtml(decl)
+
+    def handle_pi(self, data):
+        raise UnsupportedHtml(data)
+
+    def unknown_decl(self, data):
+        raise UnsupportedHtml(data)
+
+    def close_tag(self):
+        tag, attributes, children, _ = self.stack.pop()
+        text = ''.join(children)
+        parent = self.stack[-1]
+        parent[2].append(self.convert_tag(tag, attributes, text, parent))
+        parent[3] += 1
+
+    def convert_tag(self, tag, attributes, text, parent):
+        if tag in ('b', 'strong'):
+            return f'**{text}**' if text else ''
+        if tag in ('i', 'em'):
+            return f'*{text}*' if text else ''
+        if tag == 'br':
+            return '  \n'
+        if tag == 'p':
+            return f'{text}\n\n' if text else ''
+        if tag in ('ul', 'ol'):
+            if any(it[0] == 'li' for it in self.stack):
+                text = '\n' + (re.sub('^', '\t', text, flags=re.MULTILINE) if text else '')
+            return text
+        if tag == 'li':
+            if parent[0] == 'ol':
+                bullet = f'{parent[3] + 1}.'
+            else:
+                depth = sum(1 for it in self.stack if it[0] == 'ul') - 1
+                bullet = self.bullets[depth % len(self.bullets)]
+            return f'{bullet} {text}\n'
+        if tag == 'a':
+            href, title = attributes.get('href'), attributes.get('title')
+            if text == href and not title:
+                return f'<{href}>'
+            title_part = ' "%s"' % title.replace('"', r'\"') if title else ''
+            return f'[{text}]({href}{title_part})' if href else text
+        if tag == 'img':
+            title = attributes.get('title')
+            title_part = ' "%s"' % title.replace('"', r'\"') if title else ''
+            return f"![{attributes.get('alt', '')}]({attributes.get('src', '')}{title_part})"
+        return text
+
+
+def fast_markdownify(field_html):
+    try:
+        return FieldMarkdownConverter().convert(field_html)
+    except UnsupportedHtml:
+        return md(field_html)
+
+
+markdown_engines = {
+    'markdownify': md,
+    'fast': fast_markdownify,
+}
+
+
 class MarkdownExporter(Exporter):
 
-    def __init__(self, deck_name: str, profile_directory: str):
-        super().__init__(deck_name, profile_directory, ".md")
+    def __init__(self, deck_name: str, profile_directory: str, roam_cloze=False, markdown_engine='markdownify',
+                 **kwargs):
+        """
+        :param roam_cloze: convert Anki cloze deletions in the fields to Roam ones instead of keeping the Anki syntax
+        :param markdown_engine: name of the HTML to Markdown converter from markdown_engines
+        """
+        super().__init__(deck_name, profile_directory, ".md", **kwargs)
+        self.roam_cloze = roam_cloze
+        self.markdown_engine = markdown_engine
+        self.to_markdown = markdown_engines[markdown_engine]
 
     # todo cloze still duplicates notes. what I want instead is multiple scheduling rmetadata blocks
     def get_card_fragment(self, answer: str, card: Card, note: Note) -> str:
         metadata_str = ' '.join(self.get_card_metadata(card, note))
-        return ' - \n  ' + (seq(note.fields)
+        return ' - \n  ' + (seq(self.exported_fields(note))
                             .filter(lambda it: it)
-                            .map(md)
+                            .map(roam_cloze_text if self.roam_cloze else lambda it: it)
+                            .map(self.to_markdown)
                             .map(lambda it: it.replace('\n', '\n  '))
                             + seq(metadata_str)
                             ).make_string('\n  ')
 
-    def get_aggregate(self) -> str:
-        return "\n".join(self.card_fragments)
+    def checkpoint_options(self):
+        return dict(super().checkpoint_options(), roam_cloze=self.roam_cloze, markdown_engine=self.markdown_engine)
+
+    def aggregate_parts(self):
+        return '', '\n', ''
+
+    def get_tag_index(self):
+        return '\n'.join(f"{'    ' * depth}- [[{tag}]] {tag_summary(entry)}"
+                         for depth, tag, entry in self.tag_index_entries())
+
+
+def merge_shards(shard_paths, output_dir):
+    """
+    Combines the outputs of the sharded exports of a deck (see Exporter.shard) into the same files
+    a single export of the whole deck produces. Media is taken from the folders next to the shard files.
+    """
+    shards = [(Path(path), json.loads(Path(path).read_text())) for path in shard_paths]
+    _, first = shards[0]
+    count = first['shard'][1]
+    if sorted(shard['shard'][0] for _, shard in shards) != list(range(count)) or \
+            any((shard['deck_name'], shard['format'], shard['shard'][1]) !=
+                (first['deck_name'], first['format'], count) for _, shard in shards):
+        raise ValueError(f"Expected {count} shards of {first['format']} export of {first['deck_name']}")
+
+    exporter = exporters[first['format']](first['deck_name'], None, **first['options'])
+    cards = sorted(card for _, shard in shards for card in shard['cards'])
+    exporter.card_ids = [card_id for card_id, _ in cards]
+    exporter.card_fragments = [fragment for _, fragment in cards]
+    exporter.models = {int(mid): {'css': css} for _, shard in shards for mid, css in shard['css'].items()}
+    for _, shard in shards:
+        for tag, entry in shard.get('tags', {}).items():
+            merged = exporter.tags.setdefault(tag, {'cards': 0, 'due': {}})
+            merged['cards'] += entry['cards']
+            for bucket, count in entry['due'].items():
+                merged['due'][bucket] = merged['due'].get(bucket, 0) + count
+
+    dest_media_folder = Path(output_dir).joinpath(target_media_folder)
+    for path, shard in shards:
+        for media in shard['media']:
+            src = path.parent.joinpath(target_media_folder, media)
+            dest = dest_media_folder.joinpath(media)
+            if is_media_name(media) and src.exists() and not dest.exists():
+                dest_media_folder.mkdir(parents=True, exist_ok=True)
+                shutil.copyfile(src, dest)
+        exporter.images += shard['media']
+
+    exporter.write_output(output_dir)
+    print(f"Merged {len(shards)} shards with {len(cards)} cards of {first['deck_name']}")
+    return exporter
+
+
+# Rough costs of the Markdown and HTML exports together per card and per byte of the note fields,
+# used to project the output size and duration
+estimated_seconds_per_card = 0.002
+estimated_output_bytes_per_card = 220
+estimated_output_bytes_per_field_byte = 1.5
+estimated_media_bytes_per_second = 100 * 1024 * 1024
+
+
+def estimate_export(col, deck_name, media_source, children=False, include_from_dynamic=False, shard=None):
+    """
+    Estimates the size of the Markdown and HTML exports of the deck from aggregate queries
+    and the sizes of the referenced media files, without rendering any cards.
+    """
+    did = deck_id(col, deck_name)
+    condition = card_filter(col.decks, did, children, include_from_dynamic, shard)
+    cards, suspended = col.db.first(f"select count(), coalesce(sum(queue = -1), 0) from cards where {condition}")
+    all_cards = col.db.scalar(f"select count() from cards where {card_filter(col.decks, did, True, True)}")
+    exported_notes = f"select nid from cards where {condition} and queue != -1"
+    notes, models, field_bytes = col.db.first(
+        f"select count(), count(distinct mid), coalesce(sum(length(cast(flds as blob))), 0) "
+        f"from notes where id in ({exported_notes})")
+
+    media = set()
+    for fields in col.db.list(f"select flds from notes where id in ({exported_notes}) and flds like '%<img%'"):
+        media.update(extract_image_names(fields)[1])
+    media_sizes = [media_source.size(it) for it in media
+                   if media_source and is_media_name(it) and media_source.exists(it)]
+
+    exported_cards = cards - suspended
+    return {
+        'deck': deck_name,
+        'cards': cards,
+        'suspended_cards': suspended,
+        'filtered_out_cards': all_cards - cards,
+        'notes': notes,
+        'models': models,
+        'field_bytes': field_bytes,
+        'referenced_media': len(media),
+        'missing_media': len(media) - len(media_sizes),
+        'media_bytes': sum(media_sizes),
+        'projected_output_bytes': round(exported_cards * estimated_output_bytes_per_card +
+                                        field_bytes * estimated_output_bytes_per_field_byte),
+        'projected_seconds': round(exported_cards * estimated_seconds_per_card +
+                                   sum(media_sizes) / estimated_media_bytes_per_second, 1),
+    }
+
+
+def parse_shard(value):
+    index, count = (int(it) for it in value.split('/'))
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Shard index should be between 0 and {count - 1}")
+    return index, count
 
 
 def is_cloze(card: Card):
     return card.model()['type'] == MODEL_CLOZE
 
 
-def get_cards(col, deck_name):
-    return seq(get_card_ids(col.decks, col.decks.id(deck_name))) \
-        .map(col.getCard) \
-        .filter(is_not_suspended) \
-        .to_list()
+exporters = {
+    'md': MarkdownExporter,
+    'html': HtmlExporter,
+    'chunked-html': ChunkedHtmlExporter,
+}
+
+
+def collection_path(profile_directory):
+    return os.path.join(profile_directory, "collection.anki2")
+
+
+def is_package(path):
+    return Path(path).suffix.lower() in ('.apkg', '.colpkg')
+
+
+class MediaFolder:
+    """Media files of a profile, in its collection.media folder"""
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def path(self, media):
+        return os.path.join(self.folder, media)
+
+    def exists(self, media):
+        return os.path.exists(self.path(media))
+
+    def size(self, media):
+        return os.stat(self.path(media)).st_size
+
+    def copy(self, media, dest):
+        """Copies the file unless dest is already up to date, returns whether it was copied"""
+        src = self.path(media)
+        if is_up_to_date(dest, src):
+            return False
+        shutil.copyfile(src, dest)
+        return True
+
+
+class AnkiPackage:
+    """
+    An .apkg/.colpkg archive used in place of a profile directory. Anki can only open a collection from a file,
+    so the collection database is extracted to a temporary directory when it's opened, the media is streamed from
+    the archive as it's copied, using the archive's media manifest to find the files.
+    """
+
+    def __init__(self, path):
+        self.archive_path = os.path.abspath(path)
+        self.zip = zipfile.ZipFile(self.archive_path)
+        names = set(self.zip.namelist())
+        database = next((it for it in ('collection.anki21', 'collection.anki2') if it in names), None)
+        if not database:
+            self.zip.close()
+            raise ValueError(f"{path} is not an Anki package supported by this version of Anki")
+
+        # media manifest maps the names of the files in the archive ("0", "1", ...) to the media names
+        manifest = json.loads(self.zip.read('media') or '{}') if 'media' in names else {}
+        self.media = {media: member for member, media in manifest.items() if is_media_name(media)}
+
+        self.database = database
+        self.directory = tempfile.mkdtemp(prefix='anki2roam-')
+        self.cleanup = weakref.finalize(self, shutil.rmtree, self.directory, ignore_errors=True)
+        self.collection_path = os.path.join(self.directory, 'collection.anki2')
+
+    def open_collection(self):
+        # extracted on first use, the exports from a snapshot only need the media
+        if not os.path.exists(self.collection_path):
+            with self.zip.open(self.database) as src, open(self.collection_path, 'wb') as dest:
+                shutil.copyfileobj(src, dest)
+        return Collection(self.collection_path, log=True)
+
+    def path(self, media):
+        """Extracts the file, for when it has to be read from disk (e.g. by the image optimizer)"""
+        path = os.path.join(self.directory, 'media', media)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with self.zip.open(self.media[media]) as src, open(path, 'wb') as dest:
+                shutil.copyfileobj(src, dest)
+        return path
+
+    def exists(self, media):
+        return media in self.media and self.media[media] in self.zip.NameToInfo
+
+    def size(self, media):
+        return self.zip.getinfo(self.media[media]).file_size
+
+    def copy(self, media, dest):
+        if os.path.exists(dest) and os.path.getsize(dest) == self.size(media) and \
+                os.path.getmtime(dest) >= os.path.getmtime(self.archive_path):
+            return False
+        with self.zip.open(self.media[media]) as src, open(dest, 'wb') as output:
+            shutil.copyfileobj(src, output)
+        return True
+
+    def close(self):
+        self.zip.close()
+        self.cleanup()
+
+
+def is_snapshot(path):
+    return Path(path).suffix.lower() == '.snapshot'
+
+
+snapshot_schema = """
+create table meta (key text primary key, value text not null);
+create table models (id integer primary key, model text not null);
+create table notes (id integer primary key, mid integer not null, mod integer not null, tags text not null,
+                    fields text not null);
+create table cards (id integer primary key, nid integer not null, ord integer not null, deck text not null,
+                    type integer not null, queue integer not null, due integer not null, ivl integer not null,
+                    factor integer not null, answer text not null, media text not null);
+"""
+
+
+def extract_snapshot(col, deck_name, path, source, children=False, include_from_dynamic=False, fields=None):
+    """
+    Writes the rendered and normalized data of the cards of the deck to a snapshot file (see Snapshot).
+    :param source: the profile directory or package the media is copied from when exporting the snapshot
+    :param fields: {model name: [field names]} - the fields to keep, as in Exporter
+    """
+    fields = fields or {}
+    check_fields_models(col, fields)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    db = sqlite3.connect(temporary)
+    db.executescript(snapshot_schema)
+    models = {}
+    for card_id in get_card_ids(col.decks, deck_id(col, deck_name), children, include_from_dynamic):
+        card = col.getCard(card_id)
+        note = col.getNote(card.nid)
+        if note.mid not in models:
+            models[note.mid] = check_fields(col.models.get(note.mid), fields)
+        names = fields.get(models[note.mid]['name'])
+
+        # suspended cards are kept for the metrics of the exports, but are not rendered
+        answer, media = render_answer(col, card, note, models[note.mid], names) if is_not_suspended(card) else ('', [])
+        note_fields = note.fields if names is None else project_note(note, names).fields
+        db.execute("insert or ignore into notes values (?, ?, ?, ?, ?)",
+                   (note.id, note.mid, note.mod, json.dumps(note.tags), json.dumps(note_fields)))
+        db.execute("insert into cards values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                   (card.id, card.nid, card.ord, col.decks.name(card.did), card.type, card.queue, card.due, card.ivl,
+                    card.factor, answer, json.dumps(media)))
+
+    db.executemany("insert into models values (?, ?)", ((mid, json.dumps(model)) for mid, model in models.items()))
+    db.executemany("insert into meta values (?, ?)", ((key, json.dumps(value)) for key, value in {
+        'deck': deck_name, 'crt': col.crt, 'mod': col.mod, 'source': source, 'fields': fields,
+        'extracted': int(time.time())}.items()))
+    db.commit()
+    db.close()
+    os.replace(temporary, path)
+
+
+def snapshot_source(path):
+    db = sqlite3.connect(path)
+    try:
+        return json.loads(db.execute("select value from meta where key = 'source'").fetchone()[0])
+    finally:
+        db.close()
+
+
+SnapshotCard = namedtuple('SnapshotCard', 'id nid ord type queue due ivl factor answer media')
+
+
+class SnapshotNote:
+    def __init__(self, id, mid, mod, tags, fields, names):
+        self.id = id
+        self.mid = mid
+        self.mod = mod
+        self.tags = tags
+        self.fields = fields
+        self.names = names
+
+    def keys(self):
+        return self.names
+
+    def items(self):
+        return list(zip(self.names, self.fields))
+
+
+class Snapshot:
+    """
+    Rendered and normalized card data of a deck in a compact SQLite file, written by extract_snapshot.
+    Exporters read it in place of a collection (pass the file as the profile directory), without loading or rendering
+    anything with Anki, which makes exporting it again in another format or with other options cheap.
+    Cards and notes are read as records with the attributes of the Anki ones the exporters use.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        meta = {key: json.loads(value) for key, value in self.db.execute("select key, value from meta")}
+        self.deck, self.crt, self.mod, self.source, self.fields = \
+            meta['deck'], meta['crt'], meta['mod'], meta['source'], meta['fields']
+        self.models = {mid: json.loads(model) for mid, model in self.db.execute("select id, model from models")}
+        self.field_names = {mid: [it['name'] for it in sorted(model['flds'], key=lambda it: it['ord'])]
+                            for mid, model in self.models.items()}
+
+    def card_ids(self, deck_name, shard=None):
+        if deck_name != self.deck:
+            raise ValueError(f"The snapshot has the cards of the {self.deck} deck, not {deck_name}")
+        condition = f"where nid % {shard[1]} = {shard[0]}" if shard else ""
+        return [card_id for card_id, in self.db.execute(f"select id from cards {condition} order by id")]
+
+    def getCard(self, card_id):
+        row = self.db.execute("select id, nid, ord, type, queue, due, ivl, factor, answer, media from cards "
+                              "where id = ?", (card_id,)).fetchone()
+        return SnapshotCard(*row[:-1], json.loads(row[-1]))
+
+    def getNote(self, nid):
+        mid, mod, tags, fields = self.db.execute("select mid, mod, tags, fields from notes where id = ?",
+                                                 (nid,)).fetchone()
+        return SnapshotNote(nid, mid, mod, json.loads(tags), json.loads(fields), self.field_names[mid])
+
+    def close(self):
+        self.db.close()
+
+
+class PooledCollection:
+    def __init__(self, path, mtime):
+        self.path = path
+        self.mtime = mtime
+        self.collection = None  # opened by its first user, under the entry's lock rather than the pool's
+        self.lock = threading.Lock()
+        self.users = 0
+        self.evicted = False
+
+    def open(self):
+        if self.collection is None:
+            self.collection = Collection(self.path, log=True)
+        return self.collection
+
+    def close(self):
+        with self.lock:
+            if self.collection is not None:
+                self.collection.close(save=False)
+
+
+class CollectionPool:
+    """
+    Keeps recently used collections open so repeated exports don't pay for reopening them.
+    Entries are keyed by path and invalidated when the file's mtime changes. A collection is only
+    ever used by one thread at a time, exports from different collections run concurrently, and
+    opening one only blocks the requests for the same collection.
+    Collections handed out by the pool are only read from and are closed without saving.
+    """
+
+    def __init__(self, size=4):
+        self.size = size
+        self.entries = OrderedDict()  # path -> PooledCollection
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def get(self, path):
+        path = os.path.abspath(path)
+        mtime = os.stat(path).st_mtime_ns
+
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            to_close = self.evict(entry) if entry and entry.mtime != mtime else []
+            if not entry or entry.evicted:
+                entry = PooledCollection(path, mtime)
+            self.entries[path] = entry
+            entry.users += 1
+            for lru_entry in list(self.entries.values())[:-self.size]:
+                to_close += self.evict(lru_entry)
+
+        for stale in to_close:
+            stale.close()
+
+        try:
+            with entry.lock:
+                yield entry.open()
+        finally:
+            with self.lock:
+                entry.users -= 1
+                close_now = entry.evicted and not entry.users
+            if close_now:
+                entry.close()
+
+    def evict(self, entry):
+        """Drops the entry from the pool and returns it if nobody is using it and it can be closed right away"""
+        if self.entries.get(entry.path) is entry:
+            del self.entries[entry.path]
+        entry.evicted = True
+        return [] if entry.users else [entry]
+
+    def close(self):
+        with self.lock:
+            to_close = [it for entry in list(self.entries.values()) for it in self.evict(entry)]
+        for entry in to_close:
+            entry.close()
+
+
+def rename_media_references(text, renamed_media):
+    names = '|'.join(re.escape(it) for it in sorted(renamed_media, key=len, reverse=True))
+    return re.sub(fr'(?<=[/(])({names})(?=["\s)])', lambda match: renamed_media[match.group(1)], text)
+
+
+optimizable_image_extensions = {'.png', '.jpg', '.jpeg', '.webp', '.bmp', '.tif', '.tiff'}
+
+
+def optimize_image(src, dest, max_dimension, quality, image_format, cache_dir):
+    """
+    Downscales and recompresses the image, the result is cached under the hash of the source and the settings.
+    Falls back to copying the original when re-encoding doesn't make it any smaller.
+    """
+    from PIL import Image, ImageOps
+
+    source = Path(src).read_bytes()
+    # the images cached before the EXIF orientation was applied are not reused
+    settings = f"{max_dimension}:{quality}:{image_format}:upright".encode()
+    extension = f".{image_format}" if image_format else Path(src).suffix.lower()
+    cached = Path(cache_dir).joinpath(hashlib.sha1(source + settings).hexdigest()).with_suffix(extension)
+
+    if not cached.exists():
+        with Image.open(src) as image:
+            # the re-encoded image loses the EXIF data, so the orientation (e.g. of phone photos) is applied first
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((max_dimension, max_dimension))
+            pil_format = Image.registered_extensions()[extension]
+            if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+
+            temporary = cached.with_name(f"{cached.name}.{os.getpid()}.tmp")
+            image.save(temporary, pil_format, quality=quality, optimize=True)
+            if image_format is None and temporary.stat().st_size >= len(source):
+                temporary.write_bytes(source)
+            os.replace(temporary, cached)
+
+    shutil.copyfile(cached, dest)
+
+
+class ImageOptimizer:
+    """
+    Optional media processing stage: images larger than max_dimension are downscaled and recompressed with the
+    given quality, and optionally converted to another format (e.g. jpeg or webp) which renames them.
+    Images are processed in parallel worker processes. Requires Pillow.
+    """
+
+    def __init__(self, max_dimension=1600, quality=80, image_format=None, cache_dir=None, workers=None):
+        try:
+            import PIL
+        except ImportError:
+            raise ImportError("Image optimization requires Pillow, install it with: pip3 install Pillow")
+
+        self.max_dimension = max_dimension
+        self.quality = quality
+        self.image_format = image_format
+        self.cache_dir = cache_dir or os.path.join(Path.home(), ".cache", "anki2roam", "images")
+        self.workers = workers
+
+    def output_name(self, media):
+        if self.image_format and Path(media).suffix.lower() in optimizable_image_extensions:
+            return str(Path(media).with_suffix(f".{self.image_format}"))
+        return media
+
+    def pool(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # spawned rather than forked, the pipelined export creates the pool while its other stages' threads run
+        return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def submit(self, pool, src, dest_media_folder):
+        """Copies or optimizes the image in the pool, returns the future of it"""
+        media = Path(src).name
+        if Path(media).suffix.lower() not in optimizable_image_extensions:
+            return pool.submit(shutil.copyfile, src, os.path.join(dest_media_folder, media))
+        return pool.submit(optimize_image, src, os.path.join(dest_media_folder, self.output_name(media)),
+                           self.max_dimension, self.quality, self.image_format, self.cache_dir)
+
+
+class Pipeline:
+    """
+    Stages running in their own threads and connected with bounded queues. Each stage ends its output queue when
+    it is done, and when a stage fails the rest of them stop instead of blocking on a queue, so that join re-raises
+    the first error.
+    """
+    end = object()
+
+    def __init__(self):
+        self.threads = []
+        self.errors = []
+        self.failed = threading.Event()
+
+    def run(self, stage, *outputs):
+        def target():
+            try:
+                stage()
+                for output in outputs:
+                    self.put(output, self.end)
+            except BaseException as e:
+                self.errors.append(e)
+                self.failed.set()
+
+        thread = threading.Thread(target=target, name=stage.__name__, daemon=True)
+        self.threads.append(thread)
+        thread.start()
+
+    def put(self, output, item):
+        while not self.failed.is_set():
+            try:
+                return output.put(item, timeout=0.1)
+            except queue.Full:
+                pass
+        raise PipelineStopped()
+
+    def items(self, input):
+        while not self.failed.is_set():
+            try:
+                item = input.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is self.end:
+                return
+            yield item
+        raise PipelineStopped()
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+        errors = [it for it in self.errors if not isinstance(it, PipelineStopped)]
+        if errors:
+            raise errors[0]
+
+
+class PipelineStopped(Exception):
+    pass
+
+
+class RenderCache:
+    """
+    Rendered answers stored in a SQLite file, so that re-exports don't have to render the cards that didn't change.
+    Entries are keyed by note, card template and the variant of the render (the exported fields) and are invalidated
+    when either the note or its model is modified.
+    When the cache grows over max_size bytes of rendered text, the least recently used entries are evicted.
+    """
+
+    def __init__(self, path, max_size=256 * 1024 * 1024):
+        self.max_size = max_size
+        self.now = int(time.time())
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        if self.db.execute("pragma user_version").fetchone()[0] < 1:
+            # the entries of the caches without render variants are dropped
+            self.db.execute("drop table if exists renders")
+            self.db.execute("pragma user_version = 1")
+        self.db.execute("""create table if not exists renders (
+            nid integer not null,
+            ord integer not null,
+            variant text not null,
+            note_mod integer not null,
+            model_mod integer not null,
+            answer text not null,
+            media text not null,
+            size integer not null,
+            used integer not null,
+            primary key (nid, ord, variant))""")
+
+    def get(self, card, note, model, variant=''):
+        row = self.db.execute("select note_mod, model_mod, answer, media from renders "
+                              "where nid = ? and ord = ? and variant = ?", (note.id, card.ord, variant)).fetchone()
+        if not row or row[:2] != (note.mod, model['mod']):
+            return None
+
+        self.db.execute("update renders set used = ? where nid = ? and ord = ? and variant = ?",
+                        (self.now, note.id, card.ord, variant))
+        return row[2], json.loads(row[3])
+
+    def put(self, card, note, model, answer, media, variant=''):
+        self.db.execute("insert or replace into renders values (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (note.id, card.ord, variant, note.mod, model['mod'], answer, json.dumps(media), len(answer),
+                         self.now))
+
+    def evict(self):
+        excess = self.db.execute("select coalesce(sum(size), 0) from renders").fetchone()[0] - self.max_size
+        if excess <= 0:
+            return
+
+        evicted = []
+        for nid, ord, variant, size in self.db.execute("select nid, ord, variant, size from renders order by used"):
+            evicted.append((nid, ord, variant))
+            excess -= size
+            if excess <= 0:
+                break
+        self.db.executemany("delete from renders where nid = ? and ord = ? and variant = ?", evicted)
+
+    def close(self):
+        self.evict()
+        self.db.commit()
+        self.db.close()
+
+
+def check_fields(model, fields):
+    unknown_fields = set(fields.get(model['name'], [])) - {it['name'] for it in model['flds']}
+    if unknown_fields:
+        raise ValueError(f"Model {model['name']} has no fields {', '.join(sorted(unknown_fields))}")
+    return model
+
+
+def check_fields_models(col, fields):
+    """Checks the fields of all the models named in fields up front, not only of those the deck uses"""
+    models = {model['name']: model for model in col.models.all()}
+    unknown_models = set(fields) - set(models)
+    if unknown_models:
+        raise ValueError(f"No models named {', '.join(sorted(unknown_models))}")
+    for name in fields:
+        check_fields(models[name], fields)
+
+
+def render_answer(col, card, note, model, field_names=None):
+    """Renders the answer of the card, only with the given fields of the note if field_names are set"""
+    if field_names is None:
+        rendering = TemplateRenderContext.from_existing_card(card, False).render()
+    else:
+        # cloze cards share the template, the cloze number to render is taken from its ord
+        rendering = TemplateRenderContext(col, card, project_note(note, field_names), notetype=model,
+                                          template=dict(card.template(), ord=card.ord)).render()
+    return extract_image_names(rendering.answer_text)
+
+
+def project_note(note, field_names):
+    """Copy of the note with only the given fields, the others are blanked"""
+    projected = copy.copy(note)
+    projected.fields = [value if name in field_names else '' for name, value in note.items()]
+    return projected
+
+
+def parse_fields(value):
+    model, _, fields = value.rpartition(':')
+    if not model or not fields:
+        raise argparse.ArgumentTypeError("Expected the model name and its fields, e.g. Basic:Front,Back")
+    return model, [it.strip() for it in fields.split(',')]
+
+
+def deck_id(col, deck_name):
+    did = col.decks.id(deck_name, create=False)
+    if not did:
+        raise ValueError(f"Deck {deck_name} does not exist")
+    return did
 
 
 def is_not_suspended(card):
     return card.queue != -1
 
 
+def is_up_to_date(dest, src):
+    if not os.path.exists(dest):
+        return False
+    dest_stat, src_stat = os.stat(dest), os.stat(src)
+    return dest_stat.st_size == src_stat.st_size and dest_stat.st_mtime >= src_stat.st_mtime
+
+
+def peak_rss_bytes():
+    try:
+        import resource
+    except ImportError:  # not available on Windows
+        return None
+    # kilobytes on Linux, bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def run_metrics(exporters_run, started, status, error=None):
+    return {
+        'status': status,
+        'error': error,
+        'started': started,
+        'duration_seconds': round(time.time() - started, 3),
+        'peak_rss_bytes': peak_rss_bytes(),
+        'exports': [exporter.metrics for exporter in exporters_run],
+    }
+
+
+def prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_metrics(metrics):
+    lines = []
+
+    def add(name, help_text, samples):
+        lines.extend([f"# HELP anki2roam_{name} {help_text}", f"# TYPE anki2roam_{name} gauge"])
+        for labels, value in samples:
+            label_str = ','.join(f'{key}="{prometheus_label(value)}"' for key, value in labels.items())
+            lines.append(f"anki2roam_{name}{{{label_str}}} {value}" if label_str else f"anki2roam_{name} {value}")
+
+    exports = metrics['exports']
+    deck_labels = lambda it: {'deck': it['deck'], 'format': it['format']}
+    add('run_success', "Whether the last export run succeeded", [({}, int(metrics['status'] == 'ok'))])
+    add('run_started_timestamp_seconds', "When the last export run started", [({}, metrics['started'])])
+    add('run_duration_seconds', "Duration of the last export run", [({}, metrics['duration_seconds'])])
+    if metrics['peak_rss_bytes'] is not None:
+        add('peak_rss_bytes', "Peak resident memory of the export run", [({}, metrics['peak_rss_bytes'])])
+    for name, help_text in [('cards', "Cards exported"),
+                            ('suspended_cards', "Suspended cards skipped"),
+                            ('bytes_written', "Bytes of output written"),
+                            ('media_copied', "Media files copied"),
+                            ('media_skipped', "Media files already up to date in the output"),
+                            ('media_missing', "Referenced media files missing from the collection")]:
+        add(name, help_text, [(deck_labels(it), it[name]) for it in exports])
+    add('stage_seconds', "Time spent in each export stage",
+        [(dict(deck_labels(it), stage=stage), round(seconds, 6))
+         for it in exports for stage, seconds in it['stage_seconds'].items()])
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(path, metrics, metrics_format='json'):
+    """Writes the metrics atomically, so that collectors never read a partially written file"""
+    text = prometheus_metrics(metrics) if metrics_format == 'prometheus' else json.dumps(metrics, indent=2)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    Path(temporary).write_text(text)
+    os.replace(temporary, path)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('deck_name', help='Deck Name')
-    parser.add_argument('profile_directory', help='The Anki profile directory')
+    parser.add_argument('profile_directory', help='The Anki profile directory or an .apkg/.colpkg file')
     parser.add_argument('-o', '--output', help='Output directory', default=Path(__file__).parent.resolve())
+    parser.add_argument('--shared-css', help='Write HTML styles to a shared .css file instead of inlining them',
+                        action='store_true')
+    parser.add_argument('--chunked-html', help='Export HTML as a viewer page that loads chunks of cards on demand',
+                        action='store_true')
+    parser.add_argument('--search-index', help='Build a search index for the chunked HTML viewer',
+                        action='store_true')
+    parser.add_argument('--roam-cloze', help='Convert cloze deletions to Roam syntax in the Markdown export',
+                        action='store_true')
+    parser.add_argument('--shard', help='Export only the i-th of N disjoint slices of the deck, '
+                                        'combine the results with anki2roam_merge.py', type=parse_shard,
+                        metavar='i/N')
+    parser.add_argument('--markdown-engine', help='HTML to Markdown converter to use for the fields',
+                        choices=['markdownify', 'fast'], default='markdownify')
+    parser.add_argument('--fields', help='Export only these fields of the notes of the model, can be repeated '
+                                         'for several models, e.g. --fields "Basic:Front,Back"',
+                        type=parse_fields, action='append', metavar='MODEL:FIELD,...')
+    parser.add_argument('--tag-index', help='Also write an index of the tags of the exported cards',
+                        action='store_true')
+    parser.add_argument('--pipeline', help='Run loading, formatting, writing and copying media concurrently',
+                        action='store_true')
+    parser.add_argument('--checkpoint', help='Save the progress after every this many cards, '
+                                             'so that an interrupted export can be continued with --resume',
+                        type=int, metavar='N')
+    parser.add_argument('--resume', help='Continue the export from the last checkpoint', action='store_true')
+    parser.add_argument('--extract', help='Only extract the rendered cards of the deck to this .snapshot file, '
+                                          'which can be exported later in place of the profile directory',
+                        metavar='SNAPSHOT')
+    parser.add_argument('--estimate', help='Only print an estimate of the export size and duration as JSON',
+                        action='store_true')
+    parser.add_argument('--metrics', help='Write metrics of the run to this file')
+    parser.add_argument('--metrics-format', help='Format of the metrics file', choices=['json', 'prometheus'],
+                        default='json')
+    parser.add_argument('--render-cache', help='SQLite file to cache rendered cards in between the runs')
+    parser.add_argument('--max-image-dimension', help='Downscale images larger than this many pixels', type=int)
+    parser.add_argument('--image-quality', help='Quality to recompress downscaled images with', type=int,
+                        default=80)
+    parser.add_argument('--image-format', help='Convert images to this format', choices=['jpeg', 'webp', 'png'])
+    parser.add_argument('--image-cache', help='Directory to cache optimized images in')
     args = parser.parse_args()
+    if args.pipeline and (args.shard or args.chunked_html or args.checkpoint or args.resume):
+        parser.error("--pipeline can't be combined with --shard, --chunked-html or checkpoints")
+    checkpoint_every = args.checkpoint or (1000 if args.resume else None)
+    fields = dict(args.fields or [])
+    if (args.estimate or args.extract) and is_snapshot(args.profile_directory):
+        parser.error("--estimate and --extract need a profile directory or a package")
+    if args.extract and not is_snapshot(args.extract):
+        parser.error("The snapshot file should have the .snapshot extension")
+    # Anki moves the working directory to the media folder while a collection is open
+    for path_arg in ('profile_directory', 'output', 'extract', 'metrics', 'render_cache', 'image_cache'):
+        if getattr(args, path_arg):
+            setattr(args, path_arg, os.path.abspath(getattr(args, path_arg)))
+
+    # opened once and shared by all the exports
+    package = AnkiPackage(args.profile_directory) if is_package(args.profile_directory) else None
+
+    if args.extract:
+        collection = package.open_collection() if package else \
+            Collection(collection_path(args.profile_directory), log=True)
+        try:
+            extract_snapshot(collection, args.deck_name, args.extract, args.profile_directory, fields=fields)
+        finally:
+            collection.close(save=False)
+            if package:
+                package.close()
+        print(f"Extracted {args.deck_name} deck to {args.extract}")
+        exit()
+
+    if args.estimate:
+        media_source = package or MediaFolder(os.path.join(args.profile_directory, "collection.media"))
+        collection = package.open_collection() if package else \
+            Collection(collection_path(args.profile_directory), log=True)
+        try:
+            print(json.dumps(estimate_export(collection, args.deck_name, media_source, shard=args.shard), indent=2))
+        finally:
+            collection.close(save=False)
+            if package:
+                package.close()
+        exit()
 
-    MarkdownExporter(args.deck_name, args.profile_directory).export(args.output)
-    HtmlExporter(args.deck_name, args.profile_directory).export(args.output)
+    started = time.time()
+    exporters_run = []
+    status, error = 'failed', None
+    render_cache = RenderCache(args.render_cache) if args.render_cache else None
+    image_optimizer = ImageOptimizer(args.max_image_dimension or 1600, args.image_quality, args.image_format,
+                                     args.image_cache) if args.max_image_dimension or args.image_format else None
+    try:
+        html_options = dict(search_index=args.search_index) if args.chunked_html else {}
+        exporters_run.append(MarkdownExporter(
+            args.deck_name, args.profile_directory, roam_cloze=args.roam_cloze, shard=args.shard,
+            markdown_engine=args.markdown_engine, render_cache=render_cache, image_optimizer=image_optimizer,
+            pipelined=args.pipeline, package=package, checkpoint_every=checkpoint_every, resume=args.resume,
+            fields=fields, tag_index=args.tag_index))
+        exporters_run[-1].export(args.output)
+        exporters_run.append((ChunkedHtmlExporter if args.chunked_html else HtmlExporter)(
+            args.deck_name, args.profile_directory, shared_css=args.shared_css, shard=args.shard,
+            render_cache=render_cache, image_optimizer=image_optimizer, pipelined=args.pipeline,
+            package=package, checkpoint_every=checkpoint_every, resume=args.resume, fields=fields,
+            tag_index=args.tag_index, **html_options))
+        exporters_run[-1].export(args.output)
+        status = 'ok'
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        if render_cache:
+            render_cache.close()
+        if package:
+            package.close()
+        if args.metrics:
+            write_metrics(args.metrics, run_metrics(exporters_run, started, status, error), args.metrics_format)
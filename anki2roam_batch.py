@@ -0,0 +1,103 @@
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from anki import Collection
+
+from anki2roam import collection_path, exporters
+
+# Runs many exports described by a manifest, each job in its own process. The manifest is a JSON list of jobs:
+# [{"profile_directory": "/profiles/alice", "decks": ["Software", "Books"], "formats": ["md"], "output_dir": "out/alice"}]
+
+
+def export_profile(job):
+    # opening the collection moves the working directory, so the job's paths are made absolute first
+    profile_directory, output_dir = os.path.abspath(job['profile_directory']), os.path.abspath(job['output_dir'])
+    os.makedirs(output_dir, exist_ok=True)
+    collection = Collection(collection_path(profile_directory), log=True)
+    try:
+        for deck in job['decks']:
+            for export_format in job.get('formats', ['md', 'html']):
+                exporters[export_format](deck, profile_directory, collection=collection).export(output_dir)
+    finally:
+        collection.close(save=False)
+
+
+def run_job(job, connection):
+    try:
+        export_profile(job)
+        connection.send(None)
+    except Exception as e:
+        connection.send(f"{type(e).__name__}: {e}")
+
+
+def attempt_job(job, timeout):
+    """Runs the job in a fresh process, returns None on success or the error description"""
+    # spawned rather than forked, forking from the pool's threads can copy locks that other threads hold
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=run_job, args=(job, sender))
+    process.start()
+    sender.close()
+    process.join(timeout)
+
+    if process.is_alive():
+        process.terminate()
+        process.join()
+        return f"Timed out after {timeout}s"
+    if receiver.poll():
+        return receiver.recv()
+    return f"Exited with code {process.exitcode}"
+
+
+def process_job(job, timeout, retries):
+    start = time.monotonic()
+    for attempt in range(1, retries + 2):
+        error = attempt_job(job, timeout)
+        if not error:
+            break
+        print(f"{job['profile_directory']}: attempt {attempt} failed: {error}")
+
+    return {
+        'profile_directory': job['profile_directory'],
+        'decks': job['decks'],
+        'status': 'failed' if error else 'ok',
+        'attempts': attempt,
+        'duration': round(time.monotonic() - start, 3),
+        'error': error,
+    }
+
+
+def run_batch(jobs, concurrency=os.cpu_count(), timeout=None, retries=0):
+    with ThreadPoolExecutor(concurrency) as pool:
+        return list(pool.map(lambda job: process_job(job, timeout, retries), jobs))
+
+
+def print_summary(results):
+    failed = [it for it in results if it['status'] != 'ok']
+    for result in failed:
+        print(f"FAILED {result['profile_directory']} after {result['attempts']} attempts: {result['error']}")
+    print(f"{len(results) - len(failed)} of {len(results)} jobs succeeded, "
+          f"total job time {sum(it['duration'] for it in results):.1f}s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('manifest', help='JSON file with the list of export jobs')
+    parser.add_argument('-j', '--concurrency', help='Number of jobs to run in parallel', type=int,
+                        default=os.cpu_count())
+    parser.add_argument('--timeout', help='Seconds after which a job attempt is killed', type=float)
+    parser.add_argument('--retries', help='How many times to retry a failed job', type=int, default=0)
+    parser.add_argument('--report', help='Write the summary report as JSON to this file')
+    args = parser.parse_args()
+
+    results = run_batch(json.loads(open(args.manifest).read()), args.concurrency, args.timeout, args.retries)
+    print_summary(results)
+    if args.report:
+        with open(args.report, 'w') as report:
+            json.dump(results, report, indent=2)
+
+    exit(0 if all(it['status'] == 'ok' for it in results) else 1)
@@ -0,0 +1,291 @@
+import argparse
+import contextlib
+import difflib
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+
+import arrow
+from anki import Collection
+
+from anki2roam import RenderCache, collection_path, exporters, extract_snapshot, merge_shards, target_media_folder
+
+# Checks that the optimized export paths produce exactly what the reference exporters do. Every variant exports
+# the same decks with the date fixed, and its output files and media are compared byte for byte with the reference.
+# Each set of options is compared separately, the reference and the variants are all exported with it:
+# python3 anki2roam_compare.py
+# python3 anki2roam_compare.py --profile "/path/to/Anki2/User 1" --deck Software --deck Books
+
+fixed_date = arrow.get('2021-03-15T12:00:00+00:00')
+formats = ['md', 'html']
+option_sets = {
+    'tag-index': dict(tag_index=True),
+    'roam-cloze': dict(tag_index=True, markdown_options=dict(roam_cloze=True)),
+}
+
+
+class Interrupted(Exception):
+    pass
+
+
+def build_collection(profile_directory, notes=200):
+    """
+    Synthetic profile with a deck covering the edge cases of the export: formatting, entities and unbalanced lists
+    in the fields, cloze deletions with hints, present and missing images, plain and hierarchical tags, new, learning,
+    review and suspended cards, and cards in a sub-deck that are not exported.
+    """
+    os.makedirs(os.path.join(profile_directory, "collection.media"), exist_ok=True)
+    for name in ('pic.png', 'photo one.jpg', 'diagram.svg'):
+        Path(profile_directory, "collection.media", name).write_bytes(f"fake image {name}".encode() * 20)
+
+    col = Collection(collection_path(profile_directory), log=True)
+    deck, sub_deck = col.decks.id("Test"), col.decks.id("Test::Sub")
+    basic, cloze = col.models.byName("Basic"), col.models.byName("Cloze")
+    fronts = [
+        "Plain question {}",
+        "<b>Bold</b> and <i>italic</i> {} &amp; &lt;entities&gt; &nbsp;&mdash;",
+        "<ul><li>one {}</li><li>two<ul><li>nested</li></ul></li></ol>",
+        "<a href='https://example.com/?a=1&amp;b={}'>link</a> and <code>code_{}</code>",
+        "Unicode ünïcödé 日本語 {}",
+    ]
+    backs = [
+        "Answer {}<br>second line<div>in a div</div>",
+        "Image <img src=\"pic.png\"> {}",
+        "Two images <img src=\"photo one.jpg\"> <img src=\"diagram.svg\"> {}",
+        "Missing image <img src=\"missing.png\"> {}",
+        "",
+    ]
+    tags = [[], ["tag"], ["parent::child", "parent::child::grandchild"], ["ünï", "a::b"]]
+
+    for i in range(notes):
+        if i % 4 == 3:
+            col.models.setCurrent(cloze)
+            note = col.newNote()
+            note["Text"] = f"Cloze {{{{c1::one {i}}}}} and {{{{c2::<b>two</b>::hint {i}}}}}, {{{{c1::again}}}}"
+            note["Back Extra"] = backs[i % len(backs)].format(i)
+        else:
+            col.models.setCurrent(basic)
+            note = col.newNote()
+            note["Front"] = fronts[i % len(fronts)].format(i, i)
+            note["Back"] = backs[i % len(backs)].format(i)
+        note.tags = tags[i % len(tags)]
+        col.addNote(note)
+
+    for i, card_id in enumerate(col.db.list("select id from cards order by id")):
+        card = col.getCard(card_id)
+        card.did = sub_deck if i % 11 == 0 else deck
+        if i % 3 == 1:
+            card.type, card.queue, card.ivl, card.factor = 2, 2, 10 + i, 2500 + i
+            card.due = i * 3  # days since the collection creation, some of them overdue
+        elif i % 3 == 2:
+            card.type, card.queue, card.due = 1, 1, int(time.time()) + i
+        if i % 7 == 0:
+            card.queue = -1
+        card.flush()
+    col.close()
+
+
+def make_package(profile_directory, path):
+    """Packs the profile into an .apkg like Anki's own exports: collection, media manifest and numbered files"""
+    media_folder = Path(profile_directory, "collection.media")
+    media = sorted(it.name for it in media_folder.iterdir() if it.is_file())
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as package:
+        package.write(collection_path(profile_directory), 'collection.anki2')
+        package.writestr('media', json.dumps({str(number): name for number, name in enumerate(media)}))
+        for number, name in enumerate(media):
+            package.write(media_folder.joinpath(name), str(number))
+
+
+def with_options(options, markdown_options=None, **extra):
+    """The options of the set with the variant's own added"""
+    markdown_options = dict(options.get('markdown_options') or {}, **(markdown_options or {}))
+    return dict(options, **extra, markdown_options=markdown_options)
+
+
+def make_exporter(export_format, profile_directory, deck, markdown_options=None, **options):
+    format_options = dict(options, **(markdown_options or {})) if export_format == 'md' else options
+    return exporters[export_format](deck, profile_directory, now=fixed_date, **format_options)
+
+
+def export(profile_directory, deck, output_dir, **options):
+    for export_format in formats:
+        make_exporter(export_format, profile_directory, deck, **options).export(output_dir)
+
+
+def export_with_render_cache(profile_directory, deck, output_dir, work_dir, options):
+    """Compares the second export, which takes the renders from the cache, returns how long it took"""
+    cache = RenderCache(os.path.join(work_dir, "renders.sqlite"))
+    try:
+        export(profile_directory, deck, os.path.join(work_dir, "cold"), **with_options(options, render_cache=cache))
+        start = time.perf_counter()
+        export(profile_directory, deck, output_dir, **with_options(options, render_cache=cache))
+        return time.perf_counter() - start
+    finally:
+        cache.close()
+
+
+def export_sharded(profile_directory, deck, output_dir, work_dir, options, count=3):
+    for index in range(count):
+        export(profile_directory, deck, os.path.join(work_dir, f"shard-{index}"),
+               **with_options(options, shard=(index, count)))
+    for export_format in formats:
+        suffix = exporters[export_format](deck, None).file_suffix
+        merge_shards([os.path.join(work_dir, f"shard-{index}", f"{deck}{suffix}.shard-{index}-of-{count}.json")
+                      for index in range(count)], output_dir)
+
+
+def interrupt_after(exporter, cards):
+    """Makes the export fail when it gets to formatting the card after this many of them"""
+    get_card_fragment = exporter.get_card_fragment
+
+    def interrupting(*args):
+        if len(exporter.card_ids) == cards:
+            raise Interrupted()
+        return get_card_fragment(*args)
+
+    exporter.get_card_fragment = interrupting
+
+
+def export_resumed(profile_directory, deck, output_dir, work_dir, options):
+    """
+    Checkpointed exports interrupted while they format the cards: an export, a fresh one started over it, which has
+    to discard its checkpoint and is interrupted before saving its own, then a resumed one that finds no checkpoint
+    and is interrupted after saving some, and the last one resuming from those and finishing the export
+    """
+    options = with_options(options, checkpoint_every=7)
+    for export_format in formats:
+        for resume, stop_after in ((False, 20), (False, 3), (True, 50), (True, None)):
+            exporter = make_exporter(export_format, profile_directory, deck, resume=resume, **options)
+            if stop_after:
+                interrupt_after(exporter, stop_after)
+            with contextlib.suppress(Interrupted):
+                exporter.export(output_dir)
+
+
+def export_all_fields(profile_directory, deck, output_dir, work_dir, options):
+    """Exports all the fields of every model by name, which renders the cards in another way than the plain export"""
+    col = Collection(collection_path(profile_directory), log=True)
+    fields = {model['name']: [it['name'] for it in model['flds']] for model in col.models.all()}
+    col.close()
+    export(profile_directory, deck, output_dir, **with_options(options, fields=fields))
+
+
+def export_from_package(profile_directory, deck, output_dir, work_dir, options):
+    package = os.path.join(work_dir, "collection.apkg")
+    make_package(profile_directory, package)
+    export(package, deck, output_dir, **options)
+
+
+def export_from_snapshot(profile_directory, deck, output_dir, work_dir, options):
+    """Compares the export from the snapshot, returns how long it took"""
+    snapshot = os.path.join(work_dir, "deck.snapshot")
+    col = Collection(collection_path(profile_directory), log=True)
+    try:
+        extract_snapshot(col, deck, snapshot, profile_directory)
+    finally:
+        col.close()
+    start = time.perf_counter()
+    export(snapshot, deck, output_dir, **options)
+    return time.perf_counter() - start
+
+
+variants = {
+    'fast-markdown': lambda profile, deck, output, work, options: export(
+        profile, deck, output, **with_options(options, markdown_options=dict(markdown_engine='fast'))),
+    'pipeline': lambda profile, deck, output, work, options: export(
+        profile, deck, output, **with_options(options, pipelined=True)),
+    'render-cache': export_with_render_cache,
+    'shards': export_sharded,
+    'resume': export_resumed,
+    'package': export_from_package,
+    'all-fields': export_all_fields,
+    'snapshot': export_from_snapshot,
+}
+
+
+def output_files(directory):
+    return {str(it.relative_to(directory)): it.read_bytes()
+            for it in sorted(Path(directory).rglob('*')) if it.is_file()}
+
+
+def compare(reference, candidate):
+    """Lists the differences of the candidate's output and media files from the reference"""
+    differences = []
+    for kind, is_kind in (('output', lambda name: not name.startswith(target_media_folder + os.sep)),
+                          ('media', lambda name: name.startswith(target_media_folder + os.sep))):
+        expected = {name: data for name, data in reference.items() if is_kind(name)}
+        actual = {name: data for name, data in candidate.items() if is_kind(name)}
+        differences += [f"missing {kind} {it}" for it in sorted(expected.keys() - actual.keys())]
+        differences += [f"unexpected {kind} {it}" for it in sorted(actual.keys() - expected.keys())]
+        for name in sorted(expected.keys() & actual.keys()):
+            if expected[name] != actual[name]:
+                diff = difflib.unified_diff(expected[name].decode(errors='replace').splitlines(),
+                                            actual[name].decode(errors='replace').splitlines(), lineterm='', n=0)
+                differences.append(f"different {kind} {name}:\n  " + '\n  '.join(list(diff)[2:8]))
+    return differences
+
+
+def timed(function, *args):
+    """Runs the export quietly, returns its duration, unless the function measures the relevant part itself"""
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        seconds = function(*args)
+    return seconds or time.perf_counter() - start
+
+
+def run(targets, work_dir, selected_variants):
+    failures = 0
+    for (profile_directory, deck), (options_name, options) in itertools.product(targets, option_sets.items()):
+        print(f"{deck} from {profile_directory} with the {options_name} options")
+        reference_dir = os.path.join(work_dir, "reference")
+        reference_seconds = timed(lambda: export(profile_directory, deck, reference_dir, **options))
+        reference = output_files(reference_dir)
+        print(f"  {'reference':<16}{reference_seconds:8.2f}s{'':>10}  {len(reference)} files")
+
+        for name in selected_variants:
+            variant_dir = os.path.join(work_dir, name)
+            os.makedirs(variant_dir)
+            seconds = timed(variants[name], profile_directory, deck, os.path.join(variant_dir, "output"),
+                            variant_dir, options)
+            differences = compare(reference, output_files(os.path.join(variant_dir, "output")))
+            failures += bool(differences)
+            print(f"  {name:<16}{seconds:8.2f}s{reference_seconds / seconds:9.2f}x  "
+                  f"{'DIFFERENT' if differences else 'identical'}")
+            for difference in differences:
+                print(f"    {difference}")
+
+        for it in Path(work_dir).iterdir():
+            shutil.rmtree(it)
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profile', help='Profile directory to compare the exports of, instead of a synthetic one')
+    parser.add_argument('--deck', help='Deck of the profile to export, can be repeated', action='append')
+    parser.add_argument('--notes', help='Number of notes in the synthetic collection', type=int, default=200)
+    parser.add_argument('--variant', help='Variant to compare with the reference, can be repeated (default: all)',
+                        action='append', choices=list(variants))
+    args = parser.parse_args()
+    if args.profile and not args.deck:
+        parser.error("--deck is required with --profile")
+
+    with tempfile.TemporaryDirectory(prefix='anki2roam-compare-') as root:
+        if args.profile:
+            targets = [(os.path.abspath(args.profile), deck) for deck in args.deck]
+        else:
+            synthetic = os.path.join(root, "synthetic")
+            build_collection(synthetic, args.notes)
+            targets = [(synthetic, "Test")]
+
+        work_dir = os.path.join(root, "work")
+        os.makedirs(work_dir)
+        failures = run(targets, work_dir, args.variant or list(variants))
+
+    print("All variants produce identical exports" if not failures else f"{failures} variants differ")
+    exit(1 if failures else 0)
@@ -0,0 +1,38 @@
+import argparse
+import re
+from itertools import groupby
+from pathlib import Path
+
+from anki2roam import merge_shards
+
+# Combines the outputs of `anki2roam.py --shard i/N` runs, e.g. collected from several machines:
+# python3 anki2roam_merge.py shard-0/ shard-1/ shard-2/ -o output/
+
+
+shard_name_regex = re.compile(r'(.+)\.shard-\d+-of-\d+\.json')
+
+
+def find_shards(paths):
+    # the checkpoints of interrupted sharded exports (<shard file>.checkpoint.json) are left out
+    for path in map(Path, paths):
+        yield from sorted(it for it in path.iterdir() if shard_name_regex.fullmatch(it.name)) if path.is_dir() else [path]
+
+
+def shard_group(path):
+    """
+    Deck and file suffix of the export, from the shard's file name (<deck><suffix>.shard-i-of-N.json),
+    so that the shards are only parsed once, when they are merged
+    """
+    match = shard_name_regex.fullmatch(path.name)
+    return match.group(1) if match else path.name
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('shards', help='Shard files or directories with them', nargs='+')
+    parser.add_argument('-o', '--output', help='Output directory', required=True)
+    args = parser.parse_args()
+
+    Path(args.output).mkdir(parents=True, exist_ok=True)
+    for _, paths in groupby(sorted(find_shards(args.shards), key=shard_group), key=shard_group):
+        merge_shards(list(paths), args.output)
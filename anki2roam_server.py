@@ -0,0 +1,87 @@
+import argparse
+import os
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from anki2roam import CollectionPool, collection_path, exporters
+
+# Serves exports from collections that are kept open between requests, e.g.:
+# curl 'http://localhost:8765/export?profile=/path/to/Anki2/User%201&deck=Software::OS%20X&format=md'
+
+content_types = {
+    'md': 'text/markdown; charset=utf-8',
+    'html': 'text/html; charset=utf-8',
+}
+
+chunk_size = 64 * 1024
+
+
+def is_set(params, name):
+    return params.get(name, ['false'])[0].lower() in ('1', 'true', 'yes')
+
+
+class ExportHandler(BaseHTTPRequestHandler):
+    pool: CollectionPool
+    root: str  # the directory the server was started in, relative profile paths are resolved against it
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/export':
+            return self.send_error(HTTPStatus.NOT_FOUND)
+
+        params = parse_qs(url.query)
+        profile, deck, export_format = (params.get(name, [None])[0] for name in ('profile', 'deck', 'format'))
+        export_format = export_format or 'md'
+        if not profile or not deck:
+            return self.send_error(HTTPStatus.BAD_REQUEST, explain="profile and deck parameters are required")
+        profile = os.path.join(self.root, profile)
+        if export_format not in content_types:
+            return self.send_error(HTTPStatus.BAD_REQUEST, explain=f"Unknown format {export_format}")
+
+        # the messages go in the body, the status line only takes Latin-1 and deck names are often not
+        try:
+            with self.pool.get(collection_path(profile)) as collection:
+                text = exporters[export_format](deck, profile, collection=collection,
+                                                children=is_set(params, 'children'),
+                                                include_from_dynamic=is_set(params, 'dynamic')).export_text()
+        except FileNotFoundError:
+            return self.send_error(HTTPStatus.NOT_FOUND, explain=f"No collection in {profile}")
+        except ValueError as e:
+            return self.send_error(HTTPStatus.NOT_FOUND, explain=str(e))
+        except Exception as e:
+            self.log_error("Export of %r from %r failed: %r", deck, profile, e)
+            return self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, explain=f"Export failed: {e!r}")
+
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', content_types[export_format])
+        self.end_headers()
+
+        body = text.encode()
+        for start in range(0, len(body), chunk_size):
+            self.wfile.write(body[start:start + chunk_size])
+            self.wfile.flush()
+
+
+def serve(host, port, pool_size):
+    ExportHandler.pool = CollectionPool(pool_size)
+    ExportHandler.root = os.getcwd()
+    server = ThreadingHTTPServer((host, port), ExportHandler)
+    print(f"Serving exports on http://{host}:{port}/export")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        ExportHandler.pool.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', help='Interface to listen on', default='127.0.0.1')
+    parser.add_argument('-p', '--port', help='Port to listen on', type=int, default=8765)
+    parser.add_argument('--pool-size', help='How many collections to keep open', type=int, default=4)
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.pool_size)
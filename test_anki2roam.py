@@ -0,0 +1,156 @@
+import argparse
+import json
+import zipfile
+
+import pytest
+from markdownify import markdownify
+
+from anki2roam import AnkiPackage, FieldMarkdownConverter, css_rules, fast_markdownify, is_media_name, merge_shards, \
+    minify_css, parse_fields, parse_shard, prometheus_metrics, roam_cloze_html, roam_cloze_text, UnsupportedHtml
+
+
+def test_minify_css():
+    assert minify_css(".card {\n  font-family: arial;\n  color: black;\n}\n") == ".card{font-family:arial;color:black}"
+    assert minify_css("/* comment */ ul > li , ol  li { margin: 0 }") == "ul>li,ol li{margin:0}"
+
+
+def test_minify_css_keeps_quoted_strings():
+    assert minify_css('.x::after { content: ", " ; }') == '.x::after{content:", "}'
+    assert minify_css('.x::before { content: "a  ;}  b" }') == '.x::before{content:"a  ;}  b"}'
+    assert minify_css(".x { font-family: 'My  Font', serif }") == ".x{font-family:'My  Font',serif}"
+    assert minify_css('.x { content: "a \\"/* b */\\"" }') == '.x{content:"a \\"/* b */\\""}'
+
+
+def test_minify_css_drops_comments_with_quotes():
+    assert minify_css(".x { color: red } /* don't */ .y { color: blue }") == ".x{color:red}.y{color:blue}"
+
+
+def test_css_rules():
+    assert css_rules(".a{color:red}.b{color:blue}") == [".a{color:red}", ".b{color:blue}"]
+    assert css_rules('.a::before{content:"}"}.b{color:blue}') == ['.a::before{content:"}"}', ".b{color:blue}"]
+
+
+def test_css_rules_keeps_at_rules_whole():
+    css = "@media (max-width:600px){.a{color:red}}.b{color:blue}"
+    assert css_rules(css) == [css]
+    assert css_rules('.a::before{content:"@"}') == ['.a::before{content:"@"}']
+
+
+def test_fast_markdownify_charrefs():
+    for field in ('a&#65;b', 'a&#x41;b', 'a&#128;b', 'a&#0;b', 'a&#xD800;b', 'a&#xDFFF;b', 'a&#x110000;b'):
+        assert fast_markdownify(field) == markdownify(field)
+
+
+def test_is_media_name():
+    assert is_media_name("pic.png") and is_media_name("photo one.jpg") and is_media_name("a..b.png")
+    for name in ("", ".", "..", "../pwned.txt", "../../pwned.txt", "sub/pic.png", "/etc/passwd", "..\\pwned.txt"):
+        assert not is_media_name(name)
+
+
+def test_package_ignores_media_escaping_the_folder(tmp_path):
+    path = tmp_path / "deck.apkg"
+    with zipfile.ZipFile(path, 'w') as package:
+        package.writestr('collection.anki2', b'')
+        package.writestr('media', json.dumps({"0": "pic.png", "1": "../../pwned.txt", "2": ".."}))
+        for member in ("0", "1", "2"):
+            package.writestr(member, b'data')
+    package = AnkiPackage(str(path))
+    try:
+        assert package.exists("pic.png")
+        assert not package.exists("../../pwned.txt") and not package.exists("..")
+    finally:
+        package.close()
+
+
+def test_roam_cloze_html():
+    assert roam_cloze_html('a <span class="cloze">one <span class="x">b</span></span> <span>c</span>') == \
+        'a <span class="cloze">{one <span class="x">b</span>}</span> <span>c</span>'
+    assert roam_cloze_html("<span class='cloze-inactive'>x</span>") == "<span class='cloze-inactive'>x</span>"
+
+
+def test_roam_cloze_text():
+    assert roam_cloze_text("{{c1::one}} and {{c2::<b>two</b>::hint}}") == "{one} and {<b>two</b>}"
+    assert roam_cloze_text("no cloze {{Front}}") == "no cloze {{Front}}"
+
+
+@pytest.mark.parametrize('field', [
+    "Plain text with *stars* and _underscores_",
+    "<b>Bold</b> and <i>italic</i> &amp; &lt;entities&gt; &nbsp;&mdash;",
+    "Answer<br>second line<div>in a div</div>",
+    "<ul><li>one</li><li>two<ul><li>nested</li></ul></li></ul>",
+    "<a href='https://example.com/?a=1&amp;b=2'>link</a> and <code>code_1</code>",
+    "Unicode ünïcödé 日本語",
+    "<ul><li>unbalanced</li></ol>",
+    "<table><tr><td>cell</td></tr></table>",
+    "<h1>Title</h1><!-- comment --> &unknown;",
+])
+def test_fast_markdownify_matches_markdownify(field):
+    assert fast_markdownify(field) == markdownify(field)
+
+
+def test_field_markdown_converter_rejects_unsupported_html():
+    for field in ("<h1>Title</h1>", "<blockquote>quote</blockquote>", "<!-- comment -->", "&unknown;"):
+        with pytest.raises(UnsupportedHtml):
+            FieldMarkdownConverter().convert(field)
+
+
+def test_parse_shard():
+    assert parse_shard("0/3") == (0, 3)
+    assert parse_shard("2/3") == (2, 3)
+    for value in ("3/3", "-1/3"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_shard(value)
+
+
+def test_parse_fields():
+    assert parse_fields("Basic:Front, Back") == ("Basic", ["Front", "Back"])
+    assert parse_fields("Model: with colon:Text") == ("Model: with colon", ["Text"])
+    for value in ("Basic", "Basic:", ":Front"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_fields(value)
+
+
+def test_prometheus_metrics():
+    metrics = {'status': 'ok', 'started': 1.5, 'duration_seconds': 2, 'peak_rss_bytes': None, 'exports': [{
+        'deck': 'A "quoted"\\deck', 'format': 'md', 'cards': 3, 'suspended_cards': 1, 'bytes_written': 10,
+        'media_copied': 1, 'media_skipped': 0, 'media_missing': 2, 'stage_seconds': {'load': 0.1234567}}]}
+    lines = prometheus_metrics(metrics).splitlines()
+    assert "anki2roam_run_success 1" in lines
+    assert 'anki2roam_cards{deck="A \\"quoted\\"\\\\deck",format="md"} 3' in lines
+    assert 'anki2roam_stage_seconds{deck="A \\"quoted\\"\\\\deck",format="md",stage="load"} 0.123457' in lines
+    assert not any(it.startswith("anki2roam_peak_rss_bytes") for it in lines)
+
+
+def write_shard(directory, index, cards, media, tags):
+    directory.mkdir()
+    (directory / "medias").mkdir()
+    for name in media:
+        (directory / "medias" / name).write_text(name)
+    path = directory / f"Deck.md.shard-{index}-of-2.json"
+    path.write_text(json.dumps({
+        'deck_name': 'Deck', 'format': 'md', 'options': {'tag_index': True}, 'shard': [index, 2], 'css': {},
+        'cards': cards, 'media': media, 'tags': tags}))
+    return str(path)
+
+
+def test_merge_shards(tmp_path):
+    shards = [
+        write_shard(tmp_path / "shard-0", 0, [[1, " - one"], [4, " - four"]], ["a.png"],
+                    {'tag': {'cards': 2, 'due': {'today': 1, 'later': 1}}}),
+        write_shard(tmp_path / "shard-1", 1, [[2, " - two"]], ["b.png", "../escaping.png"],
+                    {'tag': {'cards': 1, 'due': {'today': 1}}, 'other': {'cards': 1, 'due': {'later': 1}}}),
+    ]
+    output = tmp_path / "output"
+    exporter = merge_shards(shards, str(output))
+
+    assert (output / "Deck.md").read_text() == " - one\n - two\n - four"
+    assert sorted(it.name for it in (output / "medias").iterdir()) == ["a.png", "b.png"]
+    assert exporter.tags == {'tag': {'cards': 3, 'due': {'today': 2, 'later': 1}},
+                             'other': {'cards': 1, 'due': {'later': 1}}}
+    assert (output / "Deck.tags.md").exists()
+
+
+def test_merge_shards_needs_all_the_shards(tmp_path):
+    shard = write_shard(tmp_path / "shard-0", 0, [[1, " - one"]], [], {})
+    with pytest.raises(ValueError):
+        merge_shards([shard], str(tmp_path / "output"))
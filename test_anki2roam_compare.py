@@ -0,0 +1,12 @@
+import pytest
+
+pytest.importorskip('anki')
+
+from anki2roam_compare import build_collection, run, variants
+
+
+def test_variants_export_like_the_reference(tmp_path):
+    profile_directory, work_dir = tmp_path / "synthetic", tmp_path / "work"
+    build_collection(str(profile_directory), notes=100)
+    work_dir.mkdir()
+    assert run([(str(profile_directory), "Test")], str(work_dir), list(variants)) == 0